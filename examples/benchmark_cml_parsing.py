@@ -0,0 +1,69 @@
+'''Benchmark of the two CML extraction engines in CMLtoPy: the XSLT path (xslt_parsing) against the direct XPath
+path (xpath_parsing), on generated multi-job Gaussian CML files. Both must return the same fields for every job.
+Usage (from the root of the repository):
+python examples/benchmark_cml_parsing.py --jobs 40 --atoms 200 --repeat 5'''
+
+import argparse
+import os
+import sys
+import tempfile
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","py_iochem"))
+from benchmark_tools import best_time
+from py_iochem import CMLtoPy as cml
+
+def gaussian_job(idx,natoms):
+	'''Text of a Gaussian cc:job module with natoms atoms and 3*natoms frequencies'''
+	atoms = "".join('<atom id="a%d" elementType="C" x3="%f" y3="%f" z3="%f"/>' % (ii,ii*0.1,ii*0.2,ii*0.3)
+					for ii in range(natoms))
+	freqs = " ".join("%.2f" % (100 + ii) for ii in range(3*natoms))
+	operation = "opt" if idx == 0 else "freq"
+	return ('''<module dictRef="cc:job"><module dictRef="cc:environment"><parameterList>
+<parameter dictRef="cc:program"><scalar dataType="xsd:string">Gaussian</scalar></parameter></parameterList></module>
+<module dictRef="cc:initialization"><parameterList><parameter dictRef="cc:method"><scalar>B3LYP</scalar></parameter>
+<parameter dictRef="cc:basis"><scalar>6-31G(d)</scalar></parameter>
+<parameter dictRef="g:operation"><scalar>%s</scalar></parameter></parameterList></module>
+<module dictRef="cc:calculation"><scalar dictRef="g:solvent">water</scalar><scalar dictRef="g:eps">78.3</scalar></module>
+<module dictRef="cc:finalization"><propertyList>
+<property><scalar dictRef="cc:hfenergy" units="nonsi:hartree">-%d.5</scalar></property>
+<property><scalar dictRef="cc:zpe.sumelectthermalfe" units="nonsi:hartree">-%d.4</scalar></property>
+<property><scalar dictRef="cc:temp" units="si:k">298.15</scalar></property>
+<property><scalar dictRef="cc:press" units="nonsi:atm">1.0</scalar></property>
+<property><scalar dictRef="cc:symmnumber">1</scalar></property>
+<property><array dictRef="cc:rottemp">0.1 0.2 0.3</array></property>
+<property><array dictRef="cc:moi.eigenvalues">1 2 3</array></property>
+<property><scalar dictRef="cc:molmass">12.0</scalar></property>
+<property><array dictRef="cc:frequency">%s</array></property></propertyList>
+<molecule id="m"><formula convention="iupac:inchi" inline="InChI=1S/CH4/h1H4"/><atomArray>%s</atomArray></molecule>
+</module></module>''' % (operation,100 + idx,100 + idx,freqs,atoms))
+
+def write_cml(filename,njobs,natoms):
+	'''Write a generated Gaussian CML file with njobs jobs of natoms atoms each'''
+	with open(filename,"w") as fcml:
+		fcml.write('<module xmlns="http://www.xml-cml.org/schema" xmlns:cc="http://www.xml-cml.org/dictionary/compchem/">')
+		fcml.write('<module dictRef="cc:jobList">')
+		for idx in range(njobs):
+			fcml.write(gaussian_job(idx,natoms))
+		fcml.write('</module></module>')
+	return None
+
+def main():
+	argparser = argparse.ArgumentParser(description="Benchmark xslt_parsing against xpath_parsing")
+	argparser.add_argument("--jobs",help="Number of cc:job entries per file",type=int,default=40)
+	argparser.add_argument("--atoms",help="Number of atoms per job",type=int,default=200)
+	argparser.add_argument("--repeat",help="Number of repetitions (best time is reported)",type=int,default=5)
+	args = argparser.parse_args()
+	with tempfile.TemporaryDirectory() as tmpdir:
+		cml_file = os.path.join(tmpdir,"bench.cml")
+		write_cml(cml_file,args.jobs,args.atoms)
+		print("CML file: %d jobs, %d atoms/job, %.1f MB" % (args.jobs,args.atoms,os.path.getsize(cml_file)/1024**2))
+		t_xslt,xslt_fields = best_time(lambda: cml.xslt_parsing(cml_file),args.repeat)
+		t_xpath,xpath_fields = best_time(lambda: cml.xpath_parsing(cml_file),args.repeat)
+	print("xslt_parsing  %8.1f ms" % (1000*t_xslt))
+	print("xpath_parsing %8.1f ms (x%.2f)" % (1000*t_xpath,t_xslt/t_xpath))
+	same = (xslt_fields == xpath_fields)
+	print("Identical output: %s" % same)
+	if (not same):
+		sys.exit(1)
+
+if (__name__ == "__main__"):
+	main()
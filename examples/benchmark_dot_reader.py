@@ -0,0 +1,65 @@
+'''Benchmark of the two DOT readers in GraphManager: the pydot-based path (pydot_dot_reader) against the direct
+parser (native_dot_reader), on generated ioChem-BD-like DOT files. Both must return the same nodes, edges,
+attributes and SerieNames.
+Usage (from the root of the repository):
+python examples/benchmark_dot_reader.py --series 10 --nodes 500 --repeat 3'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","py_iochem"))
+from benchmark_tools import best_time
+from py_iochem import GraphManager
+
+def write_dot(filename,nseries,nnodes,seed=0):
+	'''Write a generated DOT file with nnodes intermediates shared among nseries reaction profiles, and 2*nnodes
+	edges (TSs, missing or closing links) belonging to 1-3 profiles each'''
+	rng = random.Random(seed)
+	names = ["INT%d" % ii for ii in range(nnodes)]
+	with open(filename,"w") as fdot:
+		fdot.write("graph G {\nnode [shape=box];\n")
+		for name in names:
+			keys = sorted(rng.sample(range(1,nseries + 1),rng.randint(1,min(4,nseries))))
+			fdot.write('"%s" [label="%s\\nc%d", key="%s", energy="%s", tooltip="%s"];\n' %
+					   (name,name,rng.randint(0,99),",".join(map(str,keys)),",".join("0.0" for kk in keys),
+						"\\n".join("Serie %d: 0.0" % kk for kk in keys)))
+		for ii in range(2*nnodes):
+			nd1,nd2 = rng.sample(names,2)
+			for kk in rng.sample(range(1,nseries + 1),rng.randint(1,min(3,nseries))):
+				label = rng.choice(["TS%d\\nc%d" % (ii,ii),"missing","Closing"])
+				fdot.write('"%s" -- "%s" [key="%d", label="%s", energy="1.0", labeltooltip="z"];\n' %
+						   (nd1,nd2,kk,label))
+		fdot.write("}\n")
+	return None
+
+def graph_content(G):
+	'''Comparable summary of a graph: SerieNames, node attributes and edge attributes (with sorted endpoints)'''
+	nodes = {nd:dict(attrs) for nd,attrs in G.nodes(data=True)}
+	edges = {tuple(sorted((nd1,nd2))):dict(attrs) for nd1,nd2,attrs in G.edges(data=True)}
+	return G.graph.get("SerieNames"),nodes,edges
+
+def main():
+	argparser = argparse.ArgumentParser(description="Benchmark pydot_dot_reader against native_dot_reader")
+	argparser.add_argument("--series",help="Number of reaction profiles in the graph",type=int,default=10)
+	argparser.add_argument("--nodes",help="Number of intermediates",type=int,default=500)
+	argparser.add_argument("--repeat",help="Number of repetitions (best time is reported)",type=int,default=3)
+	argparser.add_argument("--seed",help="Random seed for the generated graph",type=int,default=0)
+	args = argparser.parse_args()
+	with tempfile.TemporaryDirectory() as tmpdir:
+		dot_file = os.path.join(tmpdir,"bench.dot")
+		write_dot(dot_file,args.series,args.nodes,args.seed)
+		print("DOT file: %d series, %d nodes, %.1f MB" % (args.series,args.nodes,os.path.getsize(dot_file)/1024**2))
+		t_pydot,G_pydot = best_time(lambda: GraphManager.pydot_dot_reader(dot_file),args.repeat)
+		t_native,G_native = best_time(lambda: GraphManager.native_dot_reader(dot_file),args.repeat)
+	print("Graph: %d nodes, %d edges" % (G_native.number_of_nodes(),G_native.number_of_edges()))
+	print("pydot_dot_reader  %8.1f ms" % (1000*t_pydot))
+	print("native_dot_reader %8.1f ms (x%.2f)" % (1000*t_native,t_pydot/t_native))
+	same = (graph_content(G_pydot) == graph_content(G_native))
+	print("Identical output: %s" % same)
+	if (not same):
+		sys.exit(1)
+
+if (__name__ == "__main__"):
+	main()
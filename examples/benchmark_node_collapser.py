@@ -0,0 +1,70 @@
+'''Benchmark of GraphManager.node_collapser against the previous sequential version (reference_node_collapser below),
+which copied the whole graph at every contraction. Random graphs of increasing size are generated, with about n/3
+distinct node names and 3n edges, and both versions must return the same node and edge data.
+Usage (from the root of the repository):
+python examples/benchmark_node_collapser.py --sizes 200 800 2000 --repeat 3'''
+
+import argparse
+import os
+import random
+import sys
+from collections import defaultdict
+import networkx as nx
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","py_iochem"))
+from benchmark_tools import best_time
+from py_iochem import GraphManager
+
+def reference_node_collapser(in_graph):
+	'''Previous version of GraphManager.node_collapser(), contracting same-name pairs one at a time with
+	a full copy of the graph for every contraction'''
+	match_dict = defaultdict(list)
+	for nd in in_graph.nodes(data=True):
+		match_dict[nd[1]["name"]].append(nd[0])
+
+	out_graph = in_graph.copy()
+	collapsed_node_dict = {k:v for k,v in match_dict.items() if len(v) > 1}
+	for name,nd_ids in collapsed_node_dict.items():
+		pairlist = [(nd_ids[0],nd) for nd in nd_ids[1:]]
+		for pair in pairlist:
+			out_graph = nx.contracted_nodes(out_graph,pair[0],pair[1])
+	return out_graph
+
+def random_named_graph(nnodes,seed=0):
+	'''nx.Graph with nnodes nodes, about nnodes/3 distinct names and 3*nnodes edges with name attributes'''
+	rng = random.Random(seed)
+	G = nx.Graph()
+	nnames = max(1,nnodes//3)
+	for ii in range(nnodes):
+		G.add_node("N%d" % ii,name="INT%d" % rng.randrange(nnames),energy=rng.random())
+	for ii in range(3*nnodes):
+		nd1,nd2 = rng.sample(range(nnodes),2)
+		G.add_edge("N%d" % nd1,"N%d" % nd2,name="TS%d" % ii,energy=rng.random())
+	return G
+
+def graph_content(G):
+	'''Comparable summary of a graph: node attributes and edge attributes (with sorted endpoints)'''
+	nodes = {nd:attrs for nd,attrs in G.nodes(data=True)}
+	edges = {tuple(sorted((nd1,nd2))):attrs for nd1,nd2,attrs in G.edges(data=True)}
+	return nodes,edges
+
+def main():
+	argparser = argparse.ArgumentParser(description="Benchmark node_collapser against the sequential reference")
+	argparser.add_argument("--sizes",help="Number of nodes of the generated graphs",type=int,nargs="+",
+						   default=[200,800])
+	argparser.add_argument("--repeat",help="Number of repetitions (best time is reported)",type=int,default=3)
+	argparser.add_argument("--seed",help="Random seed for the generated graphs",type=int,default=0)
+	args = argparser.parse_args()
+	all_same = True
+	print("%8s %8s %12s %12s %8s %s" % ("nodes","edges","reference/s","current/s","speedup","identical"))
+	for nnodes in args.sizes:
+		G = random_named_graph(nnodes,args.seed)
+		t_ref,G_ref = best_time(lambda: reference_node_collapser(G),args.repeat)
+		t_new,G_new = best_time(lambda: GraphManager.node_collapser(G),args.repeat)
+		same = (graph_content(G_ref) == graph_content(G_new))
+		all_same = all_same and same
+		print("%8d %8d %12.3f %12.3f %8.1f %s" % (nnodes,G.number_of_edges(),t_ref,t_new,t_ref/t_new,same))
+	if (not all_same):
+		sys.exit(1)
+
+if (__name__ == "__main__"):
+	main()
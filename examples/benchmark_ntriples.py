@@ -0,0 +1,130 @@
+'''Round-trip check and throughput benchmark of the N-Triples path of OntoRXNWrapper (export_ntriples/load_ntriples)
+against RDF/XML through owlready2, on generated ontologies.
+The round-trip check uses literals with quotes, backslashes, newlines and non-ASCII text, language-tagged strings,
+typed literals and blank nodes (class restrictions): the reloaded KG must be isomorphic to the original one and
+return the same Python values. The benchmark then saves and loads a larger generated KG in every format.
+Usage (from the root of the repository):
+python examples/benchmark_ntriples.py --individuals 20000 --repeat 3'''
+
+import argparse
+import os
+import sys
+import tempfile
+import rdflib
+from rdflib.compare import isomorphic
+from owlready2 import *
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","py_iochem"))
+from benchmark_tools import best_time
+import ontorxn_tools
+
+# Literals that need escaping in N-Triples or are not plain ASCII
+tricky_strings = ['plain','with "quotes"','back\\slash','trailing backslash\\','\\"escaped quote\\"','line\nbreak',
+				  'carriage\rreturn','tab\there','non-ASCII: àéïõü ñ ç','CJK 反応 and emoji \U0001F9EA',
+				  'literal \\u0041 escape','InChI=1S/CH4/h1H4','']
+
+def build_ontology(world,nindividuals,tricky=False):
+	'''Generate an ontology in a World, with a small class hierarchy including blank-node restrictions and nindividuals
+	individuals linked by object properties and carrying integer, float and string values. If tricky, every individual
+	also gets the strings in tricky_strings and language-tagged labels.
+	Input:
+	- world. owlready2.World object.
+	- nindividuals. Integer, number of individuals.
+	- tricky. Boolean, add the hard-to-serialize literals.
+	Output:
+	- onto. owlready2.Ontology object.'''
+	onto = world.get_ontology("http://example.org/benchmark.owl")
+	with onto:
+		class Species(Thing): pass
+		class hasNext(ObjectProperty): pass
+		class hasEnergy(DataProperty,FunctionalProperty): range = [float]
+		class hasCharge(DataProperty,FunctionalProperty): range = [int]
+		class hasNote(DataProperty): range = [str]
+		class Intermediate(Species):
+			is_a = [hasNext.some(Species) & hasNext.only(Species)]
+		individuals = [Intermediate("INT%d" % ii) for ii in range(nindividuals)]
+		for ii,ind in enumerate(individuals):
+			ind.hasNext = [individuals[(ii + 1) % nindividuals]]
+			ind.hasEnergy = -100.0 - ii*1e-3
+			ind.hasCharge = ii % 3 - 1
+			ind.hasNote = ["note %d" % ii]
+			if (tricky):
+				ind.hasNote = tricky_strings + ["index %d" % ii]
+				ind.label = [locstr("intermédiaire %d" % ii,"fr"),locstr("intermediate %d" % ii,"en")]
+	return onto
+
+def ontology_values(onto):
+	'''Python values of every individual in an ontology, to compare them after a round trip'''
+	values = {}
+	for ind in onto.individuals():
+		values[ind.name] = (sorted(ind.hasNote),sorted((str(lab),lab.lang) for lab in ind.label),ind.hasEnergy,
+							ind.hasCharge,[nxt.name for nxt in ind.hasNext])
+	return values
+
+def rdflib_graph(nt_file):
+	'''rdflib.Graph parsed from a (possibly compressed) N-Triples file'''
+	graph = rdflib.Graph()
+	with ontorxn_tools.open_triples_file(nt_file,"rb") as ftriples:
+		graph.parse(data=ftriples.read().decode("utf8"),format="nt")
+	return graph
+
+def load_ntriples_world(nt_file):
+	'''Load a N-Triples file in a new World through OntoRXNWrapper.load_ntriples()'''
+	manager = ontorxn_tools.OntoRXNWrapper()
+	manager.World = World()
+	onto = manager.World.get_ontology("http://example.org/benchmark.owl")
+	manager.load_ntriples(nt_file,onto)
+	manager.Ontology = onto
+	return manager
+
+def round_trip_check(tmpdir):
+	'''Export a small ontology with tricky literals and blank nodes to every N-Triples flavour, load it back and check
+	that the reloaded KG is isomorphic to the original one (through rdflib) and returns the same Python values.
+	Output:
+	- ok. Boolean, True if every check passed.'''
+	manager = ontorxn_tools.OntoRXNWrapper()
+	manager.World = World()
+	manager.Ontology = build_ontology(manager.World,20,tricky=True)
+	reference_values = ontology_values(manager.Ontology)
+	ok = True
+	for ext in [".nt",".nt.gz"]:
+		nt_file = os.path.join(tmpdir,"roundtrip" + ext)
+		manager.export_ntriples(nt_file)
+		reloaded = load_ntriples_world(nt_file)
+		nt_file_2 = os.path.join(tmpdir,"roundtrip_2" + ext)
+		reloaded.export_ntriples(nt_file_2)
+		same_graph = isomorphic(rdflib_graph(nt_file),rdflib_graph(nt_file_2))
+		same_values = (ontology_values(reloaded.Ontology) == reference_values)
+		print("Round trip %-7s isomorphic: %s, same values: %s" % (ext,same_graph,same_values))
+		ok = ok and same_graph and same_values
+	return ok
+
+def load_rdfxml(owl_file):
+	'''Load a RDF/XML file in a new World through owlready2'''
+	return World().get_ontology("file://" + os.path.abspath(owl_file)).load(only_local=True)
+
+def main():
+	argparser = argparse.ArgumentParser(description="Round-trip check and benchmark of N-Triples export/load")
+	argparser.add_argument("--individuals",help="Number of individuals in the benchmark KG",type=int,default=20000)
+	argparser.add_argument("--repeat",help="Number of repetitions (best time is reported)",type=int,default=3)
+	args = argparser.parse_args()
+	with tempfile.TemporaryDirectory() as tmpdir:
+		if (not round_trip_check(tmpdir)):
+			sys.exit(1)
+		manager = ontorxn_tools.OntoRXNWrapper()
+		manager.World = World()
+		manager.Ontology = build_ontology(manager.World,args.individuals)
+		ntriples = len(list(manager.Ontology.get_triples()))
+		print("Benchmark KG: %d individuals, %d triples" % (args.individuals,ntriples))
+		print("%-8s %10s %10s %12s %12s" % ("format","save/s","load/s","size/MB","load tr/s"))
+		for ext in [".owl",".nt",".nt.gz"]:
+			kg_file = os.path.join(tmpdir,"benchmark" + ext)
+			t_save,_ = best_time(lambda: manager.save_KG(kg_file),args.repeat)
+			if (ext == ".owl"):
+				t_load,_ = best_time(lambda: load_rdfxml(kg_file),args.repeat)
+			else:
+				t_load,_ = best_time(lambda: load_ntriples_world(kg_file),args.repeat)
+			print("%-8s %10.2f %10.2f %12.1f %12.0f" % (ext,t_save,t_load,os.path.getsize(kg_file)/1024**2,ntriples/t_load))
+
+if (__name__ == "__main__"):
+	main()
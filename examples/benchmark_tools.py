@@ -0,0 +1,12 @@
+'''Helpers shared by the benchmark and check scripts in this directory'''
+
+import time
+
+def best_time(function,repeat):
+	'''Best wall time of repeat calls to function, and its last result'''
+	times = []
+	for ii in range(repeat):
+		start = time.perf_counter()
+		result = function()
+		times.append(time.perf_counter() - start)
+	return min(times),result
@@ -0,0 +1,91 @@
+'''Equivalence check of the two instantiation paths of calc_instantiation() in ontorxn_tools: owlready2 objects created
+one by one (bulk=False) against the TripleEmitter writing straight to the quadstore (bulk=True). Both paths are run on
+the same generated Gaussian CML files, each in its own quadstore, and the resulting KGs must contain exactly the same
+triples and continue numbering new individuals in the same way. As the bulk path relies on owlready2 internals (numbered
+IRIs, resources and last_numbered_iri tables), this check should be run after every owlready2 upgrade.
+Usage (from the root of the repository, ONTO_DIR containing OntoRXN.owl and its imports/ directory):
+python examples/check_bulk_instantiation.py --ontofile ONTO_DIR --calcs 12 --atoms 20'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","py_iochem"))
+from benchmark_cml_parsing import write_cml
+import ontorxn_tools
+
+def instantiate(ontology_route,world_file,calcinfo,bulk):
+	'''Load OntoRXN in a new quadstore and instantiate the calculations and species in calcinfo.
+	Input:
+	- ontology_route. String, directory containing OntoRXN.owl.
+	- world_file. String, name of the SQLite file for the quadstore.
+	- calcinfo. List of calculation dicts, as for calc_instantiation()
+	- bulk. Boolean, passed to calc_instantiation()
+	Output:
+	- onto_manager. OntoRXNWrapper object with the generated KG.
+	- tracking. Tuple with the track_calcs and track_species dicts.
+	- elapsed. Float, wall time of calc_instantiation() in seconds.'''
+	onto_manager = ontorxn_tools.OntoRXNWrapper()
+	onto_manager.load_ontorxn(ontology_route,world_file)
+	start = time.perf_counter()
+	tracking = ontorxn_tools.calc_instantiation(onto_manager,calcinfo,report_id=1,nprocs=1,bulk=bulk)
+	elapsed = time.perf_counter() - start
+	return onto_manager,tracking,elapsed
+
+def graph_triples(onto_manager):
+	'''Set of all triples in the quadstore of an OntoRXNWrapper, as N3 strings, so storids do not matter'''
+	return {tuple(term.n3() for term in triple) for triple in onto_manager.MainWorld.triples((None,None,None))}
+
+def numbered_counters(onto_manager):
+	'''Last number used for every prefix of numbered names, as stored by owlready2 in the last_numbered_iri table'''
+	return dict(onto_manager.World.graph.execute("SELECT prefix,i FROM last_numbered_iri"))
+
+def next_numbered_names(onto_manager):
+	'''Names owlready2 gives to new unnamed individuals of the classes numbered during instantiation'''
+	gc = onto_manager.Namespace["gc"]
+	with onto_manager.Ontology:
+		return [onto_class(namespace=onto_manager.Ontology).name for onto_class in (gc.Atom,gc.FloatValue)]
+
+def main():
+	argparser = argparse.ArgumentParser(description="Check bulk calc_instantiation against the per-object path")
+	argparser.add_argument("--ontofile",help="Directory containing the ontology file",type=str,required=True)
+	argparser.add_argument("--calcs",help="Number of calculations",type=int,default=12)
+	argparser.add_argument("--atoms",help="Number of atoms per calculation",type=int,default=20)
+	args = argparser.parse_args()
+	ontology_route = os.path.abspath(args.ontofile)
+	repo_root = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+	# Several calculations per species name, to exercise the linking of repeated species
+	calcinfo = [{"calcId":100 + ii,"title":"mol%d" % (ii % max(1,args.calcs//2)),"calcOrder":ii}
+				for ii in range(args.calcs)]
+	with tempfile.TemporaryDirectory() as tmpdir:
+		# calc_instantiation() reads calc_CID.cml and resources/parsing_rules.dat from the working directory
+		shutil.copytree(os.path.join(repo_root,"resources"),os.path.join(tmpdir,"resources"))
+		os.chdir(tmpdir)
+		for calc in calcinfo:
+			write_cml("calc_%d.cml" % calc["calcId"],2,args.atoms)
+		results = {}
+		for bulk in (False,True):
+			results[bulk] = instantiate(ontology_route,"world_%d.sqlite3" % bulk,calcinfo,bulk)
+		triples = {bulk:graph_triples(results[bulk][0]) for bulk in results}
+		same_triples = (triples[False] == triples[True])
+		same_tracking = (results[False][1] == results[True][1])
+		counters = {bulk:numbered_counters(results[bulk][0]) for bulk in results}
+		next_names = {bulk:next_numbered_names(results[bulk][0]) for bulk in results}
+		same_numbering = (counters[False] == counters[True] and next_names[False] == next_names[True])
+		os.chdir(repo_root)
+	print("%d calculations, %d atoms each: %d triples" % (args.calcs,args.atoms,len(triples[False])))
+	print("per-object calc_instantiation %8.3f s" % results[False][2])
+	print("bulk calc_instantiation       %8.3f s (x%.2f)" % (results[True][2],results[False][2]/results[True][2]))
+	print("Identical triples: %s" % same_triples)
+	if (not same_triples):
+		print("Only per-object: %d, only bulk: %d" % (len(triples[False] - triples[True]),len(triples[True] - triples[False])))
+	print("Identical tracking dicts: %s" % same_tracking)
+	print("Same numbering counters and next names: %s %s" % (same_numbering,next_names[True]))
+	if (not (same_triples and same_tracking and same_numbering)):
+		sys.exit(1)
+
+if (__name__ == "__main__"):
+	main()
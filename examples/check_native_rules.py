@@ -0,0 +1,90 @@
+'''Equivalence check of the native OntoRXN rules (OntoRXNWrapper.native_rule_applier) against the SPARQL CONSTRUCT
+queries they replace (OntoRXNWrapper.construct_query_applier), on generated mock KGs. Both paths are run on two copies of
+the same KG and the resulting graphs must contain exactly the same triples. The mock KGs have species with several
+calculations, calculations with several different InChIs and steps sharing nodes, all created in random order.
+Usage (from the root of the repository):
+python examples/check_native_rules.py --species 50 --seeds 20'''
+
+import argparse
+import os
+import random
+import sys
+import time
+from owlready2 import *
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","py_iochem"))
+import ontorxn_tools
+
+def mock_kg(nspecies,seed):
+	'''OntoRXNWrapper holding a mock KG in a new World, with the OntoRXN classes and properties used by ontorxn_queries.
+	Input:
+	- nspecies. Integer, number of ChemSpecies individuals. There are twice as many calculations and stages.
+	- seed. Integer, seed for the random structure and the creation order of the individuals.
+	Output:
+	- manager. OntoRXNWrapper object, with Ontology, World and MainWorld set.'''
+	rng = random.Random(seed)
+	world = World()
+	onto = world.get_ontology(ontorxn_tools.rxn_iri)
+	with onto:
+		class ChemSpecies(Thing): pass
+		class CompCalculation(Thing): pass
+		class NetworkStage(Thing): pass
+		class ReactionStep(Thing): pass
+		class hasCalculation(ObjectProperty): pass
+		class isCalculationOf(ObjectProperty): inverse_property = hasCalculation
+		class hasInChI(DataProperty): pass
+		class hasNode(ObjectProperty): pass
+		class isConnectedWith(ObjectProperty): pass
+		# Calculations are created in random order, so storids do not follow names
+		calc_ids = list(range(2*nspecies))
+		rng.shuffle(calc_ids)
+		calcs = {cid:CompCalculation("CALC_%d" % cid) for cid in calc_ids}
+		for cid in calc_ids:
+			calcs[cid].hasInChI = ["InChI=1S/X%d" % rng.randrange(nspecies) for ii in range(rng.randint(0,3))]
+		for ii in range(nspecies):
+			spc = ChemSpecies("SPC_%d" % ii)
+			members = rng.sample(calc_ids,rng.randint(1,3))
+			# Some links are stated through the inverse property
+			for cid in members:
+				if (rng.random() < 0.3):
+					calcs[cid].isCalculationOf.append(spc)
+				else:
+					spc.hasCalculation.append(calcs[cid])
+		stages = [NetworkStage("STG_%d" % ii) for ii in range(2*nspecies)]
+		for ii in range(3*nspecies):
+			ReactionStep("STEP_%d" % ii).hasNode = rng.sample(stages,2)
+	manager = ontorxn_tools.OntoRXNWrapper(onto)
+	manager.World = world
+	manager.MainWorld = world.as_rdflib_graph()
+	return manager
+
+def graph_triples(manager):
+	'''Set of all triples in the KG of an OntoRXNWrapper, as N3 strings'''
+	return {tuple(term.n3() for term in triple) for triple in manager.MainWorld.triples((None,None,None))}
+
+def main():
+	argparser = argparse.ArgumentParser(description="Check native OntoRXN rules against their SPARQL queries")
+	argparser.add_argument("--species",help="Number of species in every mock KG",type=int,default=50)
+	argparser.add_argument("--seeds",help="Number of mock KGs (random seeds) to check",type=int,default=20)
+	args = argparser.parse_args()
+	all_same = True
+	print("%-14s %6s %10s %10s %8s %s" % ("rule","seed","sparql/s","native/s","triples","identical"))
+	for rule in ontorxn_tools.ontorxn_rules:
+		for seed in range(args.seeds):
+			sparql_kg = mock_kg(args.species,seed)
+			native_kg = mock_kg(args.species,seed)
+			start = time.perf_counter()
+			sparql_kg.construct_query_applier([rule])
+			t_sparql = time.perf_counter() - start
+			start = time.perf_counter()
+			native_kg.native_rule_applier([rule])
+			t_native = time.perf_counter() - start
+			triples = graph_triples(sparql_kg)
+			same = (triples == graph_triples(native_kg))
+			all_same = all_same and same
+			print("%-14s %6d %10.3f %10.3f %8d %s" % (rule,seed,t_sparql,t_native,len(triples),same))
+	if (not all_same):
+		sys.exit(1)
+
+if (__name__ == "__main__"):
+	main()
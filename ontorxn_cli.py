@@ -11,10 +11,34 @@ def arg_handling():
 	g2 = argparser.add_argument_group("Control options")
 	g2.add_argument("--fetchfiles","-f",help="Download CML files associated to the report in ioChem-BD",
 					action="store_true")
+	g2.add_argument("--sync","-s",help="Download only new or changed CML files, tracked in a local manifest",
+					action="store_true")
 	g2.add_argument("--collapse","-c",help="Collapse nodes with common names",
 					action="store_true")
 	g2.add_argument("--reasoner","-rs",help="Run default reasoner on the KG",
 					action="store_true")
+	g2.add_argument("--materialize","-m",help="Apply lightweight OntoRXN rules, saving only the inferred facts",
+					action="store_true")
+	g2.add_argument("--nprocs","-n",help="Number of processes for CML parsing (default: all CPUs)",
+					type=int,default=None)
+	g2.add_argument("--cachefile","-cf",help="SQLite file to cache parsed CML files between runs",
+					type=str,default=None)
+	g2.add_argument("--worldfile","-w",help="SQLite file to hold the quadstore on disk instead of in memory",
+					type=str,default=None)
+	g2.add_argument("--overwrite","-ow",help="Replace the SQLite file given in --worldfile if it already exists",
+					action="store_true")
+	g2.add_argument("--cachesize","-cs",help="Size (MB) of the SQLite page cache for the quadstore",
+					type=int,default=None)
+	g2.add_argument("--bulk","-b",help="Write calculation individuals to the quadstore in bulk",
+					action="store_true")
+	g2.add_argument("--native","-nt",help="Compute step links and species InChIs natively instead of via SPARQL",
+					action="store_true")
+	g2.add_argument("--format","-fmt",help="Format of the output KG file: RDF/XML (owl) or N-Triples, possibly compressed",
+					type=str,choices=["owl","nt","nt.gz","nt.zst"],default="owl")
+	g3 = argparser.add_argument_group("REST API recording")
+	g3.add_argument("--record",help="Directory to record all REST API responses",type=str,default=None)
+	g3.add_argument("--replay",help="Directory with recorded REST API responses, used instead of ioChem-BD",
+					type=str,default=None)
 	try:
 		args = argparser.parse_args()
 	except:
@@ -29,13 +53,18 @@ def main():
 	if (not args):
 		print("Could not generate the knowledge graph")
 		return None
-	outfile = args.graphfile.replace(".dot",".owl")
+	outfile = args.graphfile.replace(".dot","." + args.format)
 	if ("OntoRXN.owl" in args.ontofile):
 		args.ontofile = args.ontofile.replace("/OntoRXN.owl","")
 	knowledge_graph_gen(ontology_route=args.ontofile,report_id=args.reportid,
 						config_file=args.loginfile, graph_file=args.graphfile,
 						out_file=outfile,collapse_graph=args.collapse,
-						fetch_files=args.fetchfiles,use_reasoner=args.reasoner)
+						fetch_files=args.fetchfiles,use_reasoner=args.reasoner,
+						nprocs=args.nprocs,cache_file=args.cachefile,
+						sync_files=args.sync,record_dir=args.record,replay_dir=args.replay,
+						world_file=args.worldfile,cache_size=args.cachesize,
+						bulk_triples=args.bulk,native_inference=args.native,
+						materialize=args.materialize,overwrite=args.overwrite)
 
 if (__name__ == "__main__"):
 	main()
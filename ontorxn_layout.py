@@ -0,0 +1,355 @@
+'''Diego Garay-Ruiz, 2022
+Layout engine for the NetworkX graphs generated from OntoRXN-based knowledge graphs. Positions are computed
+by a vectorised, multilevel force-directed (Fruchterman-Reingold) algorithm, where repulsion in large graphs is
+approximated through a grid of cells, as in Barnes-Hut. Layouts can be stored on disk keyed by a structural
+hash of the graph, and graphs that grow from a previous layout only get their new nodes placed.'''
+
+import hashlib
+import json
+import os
+import numpy as np
+import networkx as nx
+
+def graph_hash(G):
+	'''Structural hash of a graph, from the names of its nodes and its (undirected) edges, regardless of their order.
+	Input:
+	- G. nx.Graph or nx.DiGraph object.
+	Output:
+	- key. String, hexadecimal SHA-256 digest.'''
+	nodes = sorted(str(nd) for nd in G.nodes)
+	edges = sorted("\t".join(sorted((str(u),str(v)))) for u,v in G.edges())
+	digest = hashlib.sha256()
+	digest.update("\n".join(nodes).encode())
+	digest.update(b"\0")
+	digest.update("\n".join(edges).encode())
+	return digest.hexdigest()
+
+def edge_array(G,index):
+	'''Unique undirected edges of a graph as an (m,2) array of node indices, without self-loops.
+	Input:
+	- G. nx.Graph or nx.DiGraph object.
+	- index. Dict mapping nodes in G to integer indices.
+	Output:
+	- edges. Integer numpy array.'''
+	pairs = {(min(index[u],index[v]),max(index[u],index[v])) for u,v in G.edges() if u != v}
+	edges = np.array(sorted(pairs),dtype=int).reshape(-1,2)
+	return edges
+
+def pair_repulsion(targets_pos,sources_pos,masses,k,excluded=None):
+	'''Sum of repulsive displacements (k^2/d, scaled by the masses) from a set of source points on a set of target points.
+	Coordinates are handled as separate 2D arrays and summed through matrix products, which is much faster than reducing
+	(targets,sources,2) arrays.
+	Input:
+	- targets_pos. Float array (t,2).
+	- sources_pos. Float array (s,2).
+	- masses. Float array (s), weight of every source.
+	- k. Float, optimal distance between nodes.
+	- excluded. Boolean array (t,s), True for pairs to be skipped. If None, all pairs are used.
+	Output:
+	- disp. Float array (t,2).'''
+	dx = targets_pos[:,0,None] - sources_pos[None,:,0]
+	dy = targets_pos[:,1,None] - sources_pos[None,:,1]
+	weights = (k*k)*masses[None,:]/np.maximum(dx*dx + dy*dy,1e-8)
+	if (excluded is not None):
+		weights[excluded] = 0.0
+	disp = targets_pos*weights.sum(axis=1)[:,None] - weights @ sources_pos
+	return disp
+
+def repulsion(pos,targets,k,exact_limit=2000,chunk_size=1000):
+	'''Repulsive displacements (k^2/d) on a set of target nodes from all nodes in the layout. For small layouts all
+	pairs are computed exactly. Otherwise nodes are binned in an adaptive grid of ~sqrt(n) cells: pairs in the same cell are
+	computed exactly and the rest of the nodes act through the centroid of their cell.
+	Input:
+	- pos. Float array (n,2) with current positions.
+	- targets. Integer array with the indices of the nodes to compute displacements for.
+	- k. Float, optimal distance between nodes.
+	- exact_limit. Integer, maximum number of nodes for the exact computation.
+	- chunk_size. Integer, number of target nodes processed at once, to bound memory usage.
+	Output:
+	- disp. Float array (len(targets),2) with the displacements.'''
+	n = len(pos)
+	disp = np.zeros((len(targets),2))
+	if (n <= exact_limit):
+		for start in range(0,len(targets),chunk_size):
+			chunk = targets[start:start + chunk_size]
+			disp[start:start + chunk_size] = pair_repulsion(pos[chunk],pos,np.ones(n),k)
+		return disp
+
+	# Adaptive grid with ~sqrt(n) cells and ~sqrt(n) nodes per cell: columns split by x quantiles, then every
+	# column split by y quantiles, so dense regions (hubs) do not end up in a single cell
+	ncells = max(2,int(np.ceil(n**0.25)))
+	column = np.empty(n,dtype=int)
+	column[np.argsort(pos[:,0],kind="stable")] = np.arange(n)*ncells//n
+	by_column = np.lexsort((pos[:,1],column))
+	column_counts = np.bincount(column,minlength=ncells)
+	column_start = np.concatenate([[0],np.cumsum(column_counts)[:-1]])
+	sorted_columns = column[by_column]
+	row = np.empty(n,dtype=int)
+	row[by_column] = (np.arange(n) - column_start[sorted_columns])*ncells//column_counts[sorted_columns]
+	cell = column*ncells + row
+	counts = np.bincount(cell,minlength=ncells*ncells)
+	occupied = np.flatnonzero(counts)
+	centroids = np.stack([np.bincount(cell,weights=pos[:,ii],minlength=ncells*ncells)[occupied]/counts[occupied]
+						  for ii in range(2)],axis=1)
+	masses = counts[occupied]
+
+	# Far field: every cell but the own one, through its centroid
+	for start in range(0,len(targets),chunk_size):
+		chunk = targets[start:start + chunk_size]
+		own_cell = cell[chunk,None] == occupied[None,:]
+		disp[start:start + chunk_size] = pair_repulsion(pos[chunk],centroids,masses,k,own_cell)
+
+	# Near field: exact pairs within the cell of every target node
+	order = np.argsort(cell,kind="stable")
+	cell_start = np.concatenate([[0],np.cumsum(counts)[:-1]])
+	target_pos = np.full(n,-1)
+	target_pos[targets] = np.arange(len(targets))
+	rows = targets
+	partners = counts[cell[rows]]
+	row_rep = np.repeat(rows,partners)
+	offsets = np.arange(partners.sum()) - np.repeat(np.cumsum(partners) - partners,partners)
+	col_rep = order[np.repeat(cell_start[cell[rows]],partners) + offsets]
+	dx = pos[row_rep,0] - pos[col_rep,0]
+	dy = pos[row_rep,1] - pos[col_rep,1]
+	weights = (k*k)/np.maximum(dx*dx + dy*dy,1e-8)
+	target_rep = target_pos[row_rep]
+	disp[:,0] += np.bincount(target_rep,weights=dx*weights,minlength=len(targets))
+	disp[:,1] += np.bincount(target_rep,weights=dy*weights,minlength=len(targets))
+	return disp
+
+def force_layout(pos,edges,k,fixed=None,iterations=50,temperature=0.1,exact_limit=2000):
+	'''Vectorised Fruchterman-Reingold refinement of a layout, following the conventions of nx.spring_layout.
+	Input:
+	- pos. Float array (n,2) with initial positions, modified in place.
+	- edges. Integer array (m,2) of node indices, as from edge_array()
+	- k. Float, optimal distance between nodes.
+	- fixed. Boolean array (n), True for nodes that must not move. If None, all nodes move.
+	- iterations. Integer, number of iterations.
+	- temperature. Float, maximum displacement in the first iteration, decreasing linearly to zero.
+	- exact_limit. Integer, passed to repulsion()
+	Output:
+	- pos. Float array (n,2) with the final positions.'''
+	n = len(pos)
+	if (fixed is None):
+		fixed = np.zeros(n,dtype=bool)
+	free = np.flatnonzero(~fixed)
+	if (not len(free)):
+		return pos
+	step = temperature/(iterations + 1)
+	for it in range(iterations):
+		disp = np.zeros((n,2))
+		disp[free] = repulsion(pos,free,k,exact_limit)
+		if (len(edges)):
+			delta = pos[edges[:,0]] - pos[edges[:,1]]
+			forces = delta*(np.sqrt((delta**2).sum(axis=1))/k)[:,None]
+			for ii in range(2):
+				disp[:,ii] -= np.bincount(edges[:,0],weights=forces[:,ii],minlength=n)
+				disp[:,ii] += np.bincount(edges[:,1],weights=forces[:,ii],minlength=n)
+		disp[fixed] = 0.0
+		length = np.sqrt((disp**2).sum(axis=1))
+		length = np.where(length < 0.01,0.1,length)
+		pos += disp*(temperature/length)[:,None]
+		temperature -= step
+	return pos
+
+def coarsen(n,edges):
+	'''Build a coarser version of a graph for multilevel layout, merging the nodes in a maximal matching and attaching
+	unmatched leaves to their neighbour, so that star-like hubs also shrink.
+	Input:
+	- n. Integer, number of nodes.
+	- edges. Integer array (m,2) of node indices.
+	Output:
+	- parent. Integer array (n) mapping each node to its node in the coarse graph.
+	- n_coarse. Integer, number of nodes in the coarse graph.
+	- coarse_edges. Integer array of edges in the coarse graph.'''
+	G = nx.Graph()
+	G.add_nodes_from(range(n))
+	G.add_edges_from(edges.tolist())
+	parent = np.full(n,-1)
+	n_coarse = 0
+	for u,v in nx.maximal_matching(G):
+		parent[u] = parent[v] = n_coarse
+		n_coarse += 1
+	for u in np.flatnonzero(parent < 0):
+		if (G.degree(u) == 1):
+			neighbor = next(iter(G[u]))
+			parent[u] = parent[neighbor]
+	unmatched = np.flatnonzero(parent < 0)
+	parent[unmatched] = np.arange(n_coarse,n_coarse + len(unmatched))
+	n_coarse += len(unmatched)
+	coarse_pairs = np.sort(parent[edges],axis=1)
+	coarse_pairs = coarse_pairs[coarse_pairs[:,0] != coarse_pairs[:,1]]
+	coarse_edges = np.unique(coarse_pairs,axis=0).reshape(-1,2)
+	return parent,n_coarse,coarse_edges
+
+def multilevel_layout(n,edges,iterations=50,seed=None,min_size=50):
+	'''Force-directed layout from scratch: the graph is coarsened repeatedly, the coarsest graph is laid out and positions
+	are then propagated and refined level by level.
+	Input:
+	- n. Integer, number of nodes.
+	- edges. Integer array (m,2) of node indices.
+	- iterations. Integer, iterations for the coarsest level. Finer levels use a third of them (at least 10).
+	- seed. Integer, seed for the random initial positions.
+	- min_size. Integer, number of nodes below which no further coarsening is done.
+	Output:
+	- pos. Float array (n,2), positions in the unit square.'''
+	rng = np.random.default_rng(seed)
+	levels = [(n,edges)]
+	parents = []
+	while (levels[-1][0] > min_size):
+		parent,n_coarse,coarse_edges = coarsen(*levels[-1])
+		if (n_coarse > 0.9*levels[-1][0]):
+			break
+		parents.append(parent)
+		levels.append((n_coarse,coarse_edges))
+	n_level,edges_level = levels[-1]
+	pos = rng.random((n_level,2))
+	pos = force_layout(pos,edges_level,1/np.sqrt(n_level),iterations=iterations)
+	for (n_level,edges_level),parent in zip(reversed(levels[:-1]),reversed(parents)):
+		k = 1/np.sqrt(n_level)
+		pos = pos[parent] + rng.normal(scale=0.1*k,size=(n_level,2))
+		pos = force_layout(pos,edges_level,k,iterations=max(10,iterations//3),temperature=0.05)
+	return pos
+
+def rescale(pos,scale=1.0):
+	'''Center positions on the origin and scale them so the largest coordinate is scale, as nx.rescale_layout()'''
+	if (not len(pos)):
+		return pos
+	pos = pos - pos.mean(axis=0)
+	lim = np.abs(pos).max()
+	if (lim > 0):
+		pos *= scale/lim
+	return pos
+
+def graph_layout(G,base_positions=None,iterations=50,seed=None):
+	'''Force-directed layout of a graph. When base_positions covers part of the nodes, these keep their positions and only
+	the rest are placed (incremental layout): first at the mean position of their already placed neighbours, then refined
+	with the fixed nodes acting on them.
+	Input:
+	- G. nx.Graph or nx.DiGraph object.
+	- base_positions. Dict mapping node names (str(node)) to positions, e.g. a previous layout of the graph.
+	- iterations. Integer, number of iterations of the force-directed algorithm.
+	- seed. Integer, seed for random initial positions.
+	Output:
+	- positions. Dict mapping nodes to numpy arrays with their coordinates, as nx.spring_layout()'''
+	nodes = list(G.nodes)
+	n = len(nodes)
+	if (n == 0):
+		return {}
+	keys = [str(nd) for nd in nodes]
+	edges = edge_array(G,{nd:ii for ii,nd in enumerate(nodes)})
+	base_positions = base_positions or {}
+	known = np.array([key in base_positions for key in keys],dtype=bool)
+	if (not known.any()):
+		pos = rescale(multilevel_layout(n,edges,iterations,seed))
+	else:
+		rng = np.random.default_rng(seed)
+		pos = np.zeros((n,2))
+		pos[known] = [base_positions[key] for key,flag in zip(keys,known) if flag]
+		mins,maxs = pos[known].min(axis=0),pos[known].max(axis=0)
+		extent = max((maxs - mins).max(),1e-3)
+		k = extent/np.sqrt(n)
+		# Place new nodes next to their placed neighbours, sweeping outwards from the known ones
+		placed = known.copy()
+		while (len(edges)):
+			sums = np.zeros((n,2))
+			counts = np.zeros(n)
+			for src,dst in ((0,1),(1,0)):
+				mask = placed[edges[:,src]] & ~placed[edges[:,dst]]
+				np.add.at(sums,edges[mask,dst],pos[edges[mask,src]])
+				np.add.at(counts,edges[mask,dst],1)
+			new = counts > 0
+			if (not new.any()):
+				break
+			pos[new] = sums[new]/counts[new,None] + rng.normal(scale=k,size=(new.sum(),2))
+			placed |= new
+		pos[~placed] = mins + rng.random(((~placed).sum(),2))*(maxs - mins)
+		pos = force_layout(pos,edges,k,fixed=known,iterations=iterations,temperature=0.1*extent)
+	positions = {nd:pos[ii] for ii,nd in enumerate(nodes)}
+	return positions
+
+class LayoutCache:
+	'''On-disk store of layouts, as JSON files named after the structural hash of the graph (graph_hash()), mapping the
+	names of the nodes to their positions. An append-only index (index.jsonl) with the node names of every layout is
+	kept in memory, so closest() does not need to read every stored layout'''
+	def __init__(self,cache_dir="layout_cache"):
+		self.cache_dir = cache_dir
+		os.makedirs(cache_dir,exist_ok=True)
+		self.index_file = os.path.join(cache_dir,"index.jsonl")
+		self.node_index = {}
+		if (os.path.isfile(self.index_file)):
+			with open(self.index_file,"r") as findex:
+				for line in findex:
+					entry = json.loads(line)
+					self.node_index[entry["key"]] = frozenset(entry["nodes"])
+		else:
+			# Build the index once for caches written without it
+			for fname in os.listdir(cache_dir):
+				if (fname.endswith(".json")):
+					self.index_layout(fname[:-5],self.get(fname[:-5]))
+
+	def index_layout(self,key,named_positions):
+		'''Add the node names of a stored layout to the in-memory index and to index.jsonl'''
+		self.node_index[key] = frozenset(named_positions)
+		with open(self.index_file,"a") as findex:
+			findex.write(json.dumps({"key":key,"nodes":list(named_positions)}) + "\n")
+		return None
+
+	def path(self,key):
+		return os.path.join(self.cache_dir,key + ".json")
+
+	def get(self,key):
+		'''Fetch the layout stored for a given hash, as a dict mapping node names to positions, or None'''
+		if (not os.path.isfile(self.path(key))):
+			return None
+		with open(self.path(key),"r") as fcache:
+			return json.load(fcache)
+
+	def put(self,key,positions):
+		'''Store a layout (dict mapping nodes to positions) for a given hash'''
+		named_positions = {str(nd):[float(xy) for xy in pos] for nd,pos in positions.items()}
+		with open(self.path(key),"w") as fcache:
+			json.dump(named_positions,fcache)
+		if (self.node_index.get(key) != frozenset(named_positions)):
+			self.index_layout(key,named_positions)
+		return None
+
+	def closest(self,node_names):
+		'''Find the stored layout sharing the most nodes with a given set of node names, to use it as base for an
+		incremental layout. Returns None if no layout shares any node.'''
+		node_names = set(node_names)
+		overlaps = [(len(node_names.intersection(stored_names)),key) for key,stored_names in self.node_index.items()]
+		# Only the best layout is read from disk, skipping layouts whose files were removed
+		for overlap,key in sorted(overlaps,reverse=True):
+			if (overlap == 0):
+				break
+			stored = self.get(key)
+			if (stored is not None):
+				return stored
+		return None
+
+def cached_layout(G,cache=None,base_positions=None,incremental=True,iterations=50,seed=None):
+	'''Layout of a graph reusing previous work: stored layouts for the same structure are returned directly and, when
+	incremental, graphs that share nodes with a previous layout only get their new nodes placed.
+	Input:
+	- G. nx.Graph or nx.DiGraph object.
+	- cache. LayoutCache object. If None, nothing is stored.
+	- base_positions. Dict mapping node names to positions of a previous layout. If None and incremental, the stored
+	layout sharing most nodes with G is used.
+	- incremental. Boolean, if False always compute the layout from scratch.
+	- iterations, seed. As in graph_layout()
+	Output:
+	- positions. Dict mapping nodes to numpy arrays with their coordinates.'''
+	key = graph_hash(G)
+	if (cache):
+		stored = cache.get(key)
+		if (stored and all(str(nd) in stored for nd in G.nodes)):
+			return {nd:np.array(stored[str(nd)]) for nd in G.nodes}
+	if (not incremental):
+		base_positions = None
+	elif (base_positions is None and cache):
+		base_positions = cache.closest(str(nd) for nd in G.nodes)
+	positions = graph_layout(G,base_positions,iterations,seed)
+	if (cache):
+		cache.put(key,positions)
+	return positions
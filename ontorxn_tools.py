@@ -3,16 +3,27 @@ Collection of Python functions to manage and generate OntoRXN-compliant knowledg
 graphs.'''
 
 from py_iochem import ReportHandler
+from py_iochem import CMLCache
 from py_iochem import CMLtoPy as cml
 from py_iochem import GraphManager
+import ontorxn_layout
 import re
 import os.path
+import gzip
+import io
 import networkx as nx
 from networkx.drawing.nx_pydot import read_dot
 from owlready2 import *
 import rdflib
 from rdflib.extras.external_graph_libs import rdflib_to_networkx_digraph
+from rdflib.plugins.sparql import prepareQuery
 from operator import itemgetter
+from owlready2.driver import INT_DATATYPES,FLOAT_DATATYPES
+from owlready2.base import _universal_datatype_2_abbrev
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 # SPARQL queries for linking entities that cannot be directly inferred
 
@@ -28,12 +39,51 @@ ontorxn_queries = {
 	"inchi_mapper":"""
 	PREFIX rxn: <http://www.semanticweb.com/OntoRxn#>
 	CONSTRUCT { ?spcX rxn:hasInChI ?inchiX }
-	WHERE { SELECT ?spcX ?inchiX WHERE {
+	WHERE { SELECT ?spcX (MIN(?inchiY) AS ?inchiX) WHERE {
 		?spcX rxn:hasCalculation ?calcX .
-		?calcX rxn:hasInChI ?inchiX }
+		?calcX rxn:hasInChI ?inchiY }
 	GROUP BY ?spcX }
 	"""}
 
+# Native counterparts of the queries above, as names of OntoRXNWrapper methods returning the inferred quads
+ontorxn_rules = {
+	"step_linker":"step_linker_rule",
+	"inchi_mapper":"inchi_mapper_rule"}
+
+rxn_iri = "http://www.semanticweb.com/OntoRxn#"
+
+# Extensions of N-Triples files, handled by export_ntriples() and load_KG() instead of RDF/XML
+ntriples_extensions = (".nt",".nt.gz",".nt.zst")
+# Datatype (storid of xsd:string) under which owlready2 stores plain literals, without datatype or language tag
+plain_literal_datatype = _universal_datatype_2_abbrev[str]
+
+def open_triples_file(filename,mode="rb",compression_level=None):
+	'''Open a N-Triples file as a binary stream, compressed with gzip or zstd according to its extension (.gz, .zst),
+	so triples can be written or read progressively without holding the whole file in memory.
+	Input:
+	- filename. String, name of the file.
+	- mode. String, "rb" or "wb".
+	- compression_level. Integer, compression level for gzip (1-9, default 6) or zstd (1-22, default 3).
+	Output:
+	- ftriples. Binary file object, to be closed by the caller.'''
+	if (filename.endswith(".gz")):
+		return gzip.open(filename,mode,compresslevel=compression_level or 6)
+	if (filename.endswith(".zst")):
+		if (not zstandard):
+			raise ImportError("zstandard is required to read or write .zst files: pip install zstandard")
+		if (mode.startswith("w")):
+			return zstandard.ZstdCompressor(level=compression_level or 3).stream_writer(open(filename,"wb"))
+		return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename,"rb")))
+	return open(filename,mode)
+
+def suffixed_filename(filename,suffix):
+	'''Add a suffix to a filename before its extension, handling compressed N-Triples: kg.owl -> kg_suffix.owl and
+	kg.nt.gz -> kg_suffix.nt.gz'''
+	for ext in sorted(ntriples_extensions + (".owl",),key=len,reverse=True):
+		if (filename.endswith(ext)):
+			return filename[:-len(ext)] + suffix + ext
+	return filename + suffix
+
 class OntoRXNWrapper:
 	'''Class to simplify I/O on ontology processing, handling the owlready2.Ontology object, the rdflib World (which can
 	be queried directly) and the namespaces'''
@@ -42,6 +92,15 @@ class OntoRXNWrapper:
 		self.Ontology = ontology
 		# Namespace dependencies
 		self.Namespace = {}
+		# Quadstore: owlready2.World and SQLite file backing it, if any
+		self.World = default_world
+		self.WorldFile = None
+		# Query registry: SPARQL strings by name, prepared queries and cached results
+		self.Queries = dict(ontorxn_queries)
+		self.PreparedQueries = {}
+		self.QueryCache = {}
+		# Positions of the last layout, used as base for incremental layouts
+		self.LastPositions = None
 
 	def process_onto(self):
 		'''Basic processing for OntoRXN (clean ontology or instantiated graphs): prepare imports,
@@ -62,45 +121,471 @@ class OntoRXNWrapper:
 		}
 		self.Namespace.update(namespace_dict)
 		self.MainClassList = list(self.Ontology.classes())
+		# Prepared queries and results are bound to the world
+		self.PreparedQueries = {}
+		self.QueryCache = {}
 		return None
 		
-	def load_ontorxn(self,ontology_path):
+	def world_builder(self,world_file=None,cache_size=None,exclusive=True):
+		'''Instantiate the owlready2 World holding the quadstore, either in memory or backed by an on-disk
+		SQLite file, so large KGs do not need to fit in RAM and can be reopened without re-parsing RDF/XML.
+		Input:
+		- world_file. String, name of the SQLite file for the quadstore. If None, the default in-memory World is used.
+		- cache_size. Integer, size in MB of the SQLite page cache. If None, the owlready2 default (~200 MB) is kept.
+		- exclusive. Boolean, if True lock the SQLite file for this process only, which speeds up writes.
+		Output:
+		- world. owlready2.World object, also stored in self.World.'''
+		if (world_file):
+			world = World(filename=world_file,exclusive=exclusive)
+		else:
+			world = default_world
+		if (cache_size):
+			world.graph.execute("PRAGMA cache_size = -%d" % (cache_size*1000))
+		self.World = world
+		self.WorldFile = world_file
+		return world
+
+	def stored_ontology(self,world):
+		'''Fetch the main ontology already stored in a World backed by a SQLite quadstore, defined as the one importing
+		other ontologies without being imported by any of them.
+		Input:
+		- world. owlready2.World object, as generated by self.world_builder()
+		Output:
+		- ontology. owlready2.Ontology object, or None if the quadstore is empty.'''
+		stored = [onto.load() for iri,onto in world.ontologies.items() if iri != "http://anonymous/"]
+		imported = [imp for onto in stored for imp in onto.imported_ontologies]
+		roots = [onto for onto in stored if onto.imported_ontologies and onto not in imported]
+		if (not roots):
+			return None
+		return roots[0]
+
+	def save_world(self):
+		'''Commit all pending changes to the SQLite quadstore, if any is used'''
+		if (self.WorldFile):
+			self.World.save()
+		return None
+
+	def load_ontorxn(self,ontology_path,world_file=None,cache_size=None,exclusive=True):
 		'''Custom function to load a clean instance OntoRXN and its local imports.
 		Input:
-		- ontology_path. String, full path to the OntoRXN instance to load.'''
+		- ontology_path. String, full path to the OntoRXN instance to load.
+		- world_file, cache_size, exclusive. Setup of the quadstore, as in self.world_builder()'''
 		onto_path.extend([ontology_path,ontology_path + "/imports"])
-		ontology = get_ontology("OntoRXN.owl").load(only_local=True)
+		world = self.world_builder(world_file,cache_size,exclusive)
+		ontology = world.get_ontology("OntoRXN.owl").load(only_local=True)
 		self.Ontology = ontology
 		self.process_onto()
 		# Also get the corresponding world
-		self.MainWorld = default_world.as_rdflib_graph()
+		self.MainWorld = world.as_rdflib_graph()
 		return None
 
-	def load_KG(self,KG_filename):
+	def load_KG(self,KG_filename=None,world_file=None,cache_size=None,exclusive=True):
 		''' Function to load a OntoRXN-based knowledge graph from a local file, handling imports and
-		the corresponding RDFLib-compatible world.
+		the corresponding RDFLib-compatible world. If world_file points to an existing SQLite quadstore, the KG
+		stored there is reopened directly, without parsing any file.
 		Input:
-		- KG_filename. String, name of the file to be read.'''
+		- KG_filename. String, name of the file to be read: RDF/XML, or N-Triples (.nt, .nt.gz, .nt.zst) as written by
+		self.export_ntriples()
+		- world_file, cache_size, exclusive. Setup of the quadstore, as in self.world_builder()
+		Raises ValueError if KG_filename is not given and world_file holds no stored KG.'''
 		onto_path.append("")
 		# Instantiate a new world
-		onto_world = World()
-		ontology = onto_world.get_ontology(KG_filename).load(only_local=True)
+		if (world_file):
+			onto_world = self.world_builder(world_file,cache_size,exclusive)
+		else:
+			onto_world = World()
+			self.World = onto_world
+			self.WorldFile = None
+		ontology = None
+		if (world_file):
+			ontology = self.stored_ontology(onto_world)
+		if (ontology is None and not KG_filename):
+			raise ValueError("A KG_filename is required when world_file does not hold a stored KG (world_file: %s)" % world_file)
+		if (ontology is None and KG_filename.endswith(ntriples_extensions)):
+			ontology = onto_world.get_ontology(KG_filename)
+			self.load_ntriples(KG_filename,ontology)
+			self.save_world()
+		elif (ontology is None):
+			ontology = onto_world.get_ontology(KG_filename).load(only_local=True)
+			self.save_world()
 		self.Ontology = ontology
 		self.MainWorld = onto_world.as_rdflib_graph()
 		self.process_onto()
 		return None
 
+	def export_ntriples(self,out_file,ontology=None,batch_size=100000,compression_level=None):
+		'''Stream the triples of an ontology (by default, the KG in self.Ontology) to a N-Triples file, optionally
+		compressed (.nt.gz, .nt.zst). Triples are read straight from the quadstore tables and written in batches, so
+		the serialization is never held in memory as a whole: only a storid -> IRI lookup table is kept.
+		Input:
+		- out_file. String, name of the file to be written.
+		- ontology. owlready2.Ontology object whose triples are exported. If None, self.Ontology is used.
+		- batch_size. Integer, number of triples fetched and written at once.
+		- compression_level. Integer, passed to open_triples_file()
+		Output:
+		- ntriples. Integer, number of triples written.'''
+		ontology = ontology or self.Ontology
+		db = self.World.graph.db
+		iris = dict(db.execute("SELECT storid,'<' || iri || '>' FROM resources"))
+		def node(storid):
+			return iris.get(storid) or "_:%d" % (-storid)
+		def literal(value,datatype):
+			if (isinstance(value,str)):
+				value = value.replace("\\","\\\\").replace('"','\\"').replace("\n","\\n").replace("\r","\\r")
+			if (isinstance(datatype,str) and datatype.startswith("@")):
+				return '"%s"%s' % (value,datatype)
+			if (datatype):
+				return '"%s"^^%s' % (value,iris[datatype])
+			return '"%s"' % value
+		ntriples = 0
+		cursor = db.cursor()
+		with open_triples_file(out_file,"wb",compression_level) as ftriples:
+			cursor.execute("SELECT s,p,o FROM objs WHERE c = ?",(ontology.graph.c,))
+			for rows in iter(lambda: cursor.fetchmany(batch_size),[]):
+				lines = ["%s %s %s .\n" % (node(s),iris[p],node(o)) for s,p,o in rows]
+				ftriples.write("".join(lines).encode("utf8"))
+				ntriples += len(rows)
+			cursor.execute("SELECT s,p,o,d FROM datas WHERE c = ?",(ontology.graph.c,))
+			for rows in iter(lambda: cursor.fetchmany(batch_size),[]):
+				lines = ["%s %s %s .\n" % (node(s),iris[p],literal(o,d)) for s,p,o,d in rows]
+				ftriples.write("".join(lines).encode("utf8"))
+				ntriples += len(rows)
+		cursor.close()
+		return ntriples
+
+	def load_ntriples(self,nt_file,ontology,batch_size=1<<24):
+		'''Bulk-load a N-Triples file, optionally compressed (.nt.gz, .nt.zst), into an ontology, replacing its triples.
+		The file is streamed in blocks of lines, IRIs are mapped to storids through an in-memory table and rows are inserted
+		straight into the quadstore tables, with the non-unique indexes rebuilt once at the end instead of being updated for
+		every row. The ontology is then finalized by owlready2 (base IRI, imports, properties) as for any parsed file.
+		Input:
+		- nt_file. String, name of the N-Triples file, e.g. as written by self.export_ntriples()
+		- ontology. owlready2.Ontology object to load the triples into, e.g. from World.get_ontology()
+		- batch_size. Integer, approximate size in bytes of the blocks of lines read and inserted at once.
+		Output:
+		- ntriples. Integer, number of triples read.'''
+		graph = self.World.graph
+		db = graph.db
+		c = ontology.graph.c
+		storids = dict(db.execute("SELECT iri,storid FROM resources"))
+		current_resource = db.execute("SELECT current_resource FROM store").fetchone()[0]
+		new_resources = []
+		def new_storid(iri):
+			nonlocal current_resource
+			if (iri.startswith("_:")):
+				storids[iri] = graph.new_blank_node()
+			else:
+				current_resource += 1
+				storids[iri] = current_resource
+				new_resources.append((current_resource,iri))
+			return storids[iri]
+		def node(term):
+			term = term[1:-1] if term.startswith("<") else term
+			return storids.get(term) or new_storid(term)
+		ntriples = 0
+		graph.acquire_write_lock()
+		cursor = db.cursor()
+		# Unique indexes are kept, as they discard repeated triples
+		indexes = cursor.execute("""SELECT name,sql FROM sqlite_master WHERE type = 'index' AND tbl_name IN ('objs','datas')
+		AND sql NOT LIKE 'CREATE UNIQUE%'""").fetchall()
+		try:
+			cursor.execute("DELETE FROM objs WHERE c = ?",(c,))
+			cursor.execute("DELETE FROM datas WHERE c = ?",(c,))
+			for name,sql in indexes:
+				cursor.execute("DROP INDEX %s" % name)
+			with open_triples_file(nt_file,"rb") as fbinary:
+				ftriples = io.TextIOWrapper(fbinary,encoding="utf8")
+				for lines in iter(lambda: ftriples.readlines(batch_size),[]):
+					objs = []
+					datas = []
+					for line in lines:
+						line = line.strip()
+						if (not line or line.startswith("#")):
+							continue
+						s,p,o = line[:-1].rstrip().split(None,2)
+						s,p = node(s),node(p)
+						if (not o.startswith('"')):
+							objs.append((s,p,node(o)))
+							continue
+						value,_,datatype = o[1:].rpartition('"')
+						if ("\\" in value):
+							value = value.encode("raw-unicode-escape").decode("unicode-escape")
+						if (datatype.startswith("^^")):
+							datatype = datatype[3:-1]
+							if (datatype in INT_DATATYPES):
+								value = int(value)
+							elif (datatype in FLOAT_DATATYPES):
+								value = float(value)
+							datatype = node(datatype)
+						elif (not datatype):
+							datatype = plain_literal_datatype
+						datas.append((s,p,value,datatype))
+					cursor.executemany("INSERT INTO resources VALUES (?,?)",new_resources)
+					new_resources.clear()
+					cursor.executemany("INSERT OR IGNORE INTO objs VALUES (%d,?,?,?)" % c,objs)
+					cursor.executemany("INSERT OR IGNORE INTO datas VALUES (%d,?,?,?,?)" % c,datas)
+					ntriples += len(objs) + len(datas)
+			cursor.execute("UPDATE store SET current_resource = ?",(current_resource,))
+		finally:
+			for name,sql in indexes:
+				cursor.execute(sql.replace("CREATE INDEX","CREATE INDEX IF NOT EXISTS",1))
+			graph.release_write_lock()
+		# Let owlready2 finalize the ontology from the stored triples, parsing an empty stream
+		ontology.load(only_local=True,fileobj=io.BytesIO(b""),format="ntriples",delete_existing_triples=False)
+		return ntriples
+
+	def save_KG(self,out_file,ontology=None):
+		'''Write an ontology (by default, the KG in self.Ontology) to a file: N-Triples through self.export_ntriples()
+		for .nt, .nt.gz and .nt.zst files, RDF/XML through owlready2 otherwise.
+		Input:
+		- out_file. String, name of the file to be written.
+		- ontology. owlready2.Ontology object to be saved. If None, self.Ontology is used.'''
+		ontology = ontology or self.Ontology
+		if (out_file.endswith(ntriples_extensions)):
+			self.export_ntriples(out_file,ontology)
+		else:
+			ontology.save(out_file)
+		return None
+
+	def register_query(self,name,query_string):
+		'''Add a SPARQL query to the registry in self.Queries, so it can be run by name through self.query()
+		Input:
+		- name. String, name for the query.
+		- query_string. String, valid SPARQL query.'''
+		self.Queries[name] = query_string
+		return None
+
+	def prepare_query(self,query,backend="rdflib"):
+		'''Parse and translate a SPARQL query only once, keeping the prepared query in self.PreparedQueries.
+		Input:
+		- query. String, name of a query in self.Queries or a valid SPARQL query.
+		- backend. String, "rdflib" to run the query through RDFLib on self.MainWorld, or "owlready" to translate it to SQL
+		through the native SPARQL engine of owlready2 (no CONSTRUCT nor DESCRIBE queries).
+		Output:
+		- prepared. Prepared query object for the chosen backend.'''
+		query_string = self.Queries.get(query,query)
+		prepared = self.PreparedQueries.get((backend,query_string))
+		if (prepared is None):
+			if (backend == "rdflib"):
+				prepared = prepareQuery(query_string)
+			elif (backend == "owlready"):
+				prepared = self.Ontology.world.prepare_sparql(query_string)
+			else:
+				raise ValueError("Unknown query backend %s" % backend)
+			self.PreparedQueries[(backend,query_string)] = prepared
+		return prepared
+
+	def store_state(self):
+		'''Counter of the rows changed in the quadstore so far, used to invalidate cached query results'''
+		return self.Ontology.world.graph.db.total_changes
+
+	def query(self,query,backend="rdflib",bindings=None,use_cache=True):
+		'''Run a SPARQL query through a prepared query, reusing the results of previous runs while the quadstore is unchanged.
+		Input:
+		- query. String, name of a query in self.Queries or a valid SPARQL query.
+		- backend. String, "rdflib" or "owlready", as in self.prepare_query()
+		- bindings. Initial values for the variables in the query: dict mapping variable names to RDFLib terms for rdflib,
+		or list of parameters (?? in the query) for owlready.
+		- use_cache. Boolean, if False always run the query.
+		Output:
+		- results. List of rows (or triples for CONSTRUCT queries). With the owlready backend, rows contain owlready2 entities
+		and Python values instead of RDFLib terms.'''
+		prepared = self.prepare_query(query,backend)
+		if (backend == "rdflib"):
+			cache_key = (backend,self.Queries.get(query,query),tuple(sorted((bindings or {}).items())))
+		else:
+			cache_key = (backend,self.Queries.get(query,query),tuple(bindings or ()))
+		cached = self.QueryCache.get(cache_key)
+		if (use_cache and cached and cached[0] == self.store_state()):
+			return cached[1]
+		if (backend == "rdflib"):
+			results = list(self.MainWorld.query(prepared,initBindings=bindings or {}))
+		else:
+			results = list(prepared.execute(tuple(bindings or ())))
+		if (use_cache):
+			self.QueryCache[cache_key] = (self.store_state(),results)
+		return results
 
 	def construct_query_applier(self,query_list):
 		'''For a given ontology, get the corresponding RDFLib world and apply a
 		sequence of SPARQL CONSTRUCT queries, passed as a list.
 		Input:
-		- query_list. List of strings containing valid SPARQL queries'''
-		inference_seq = [self.MainWorld.query(qx) for qx in query_list]
+		- query_list. List of strings containing valid SPARQL queries, or names of queries in self.Queries'''
+		inference_seq = [self.query(qx,use_cache=False) for qx in query_list]
 		with self.Ontology:
 			[self.MainWorld.add(fact) for inference in inference_seq for fact in inference]
 		return None
 
+	def class_index_builder(self):
+		'''Map the IRI of every individual of the OntoRXN main classes to the index of its class in self.MainClassList,
+		from a single query over the rdf:type triples in the quadstore. When an individual has several of these
+		classes, the first asserted one is kept (rows in insertion order), as in is_a[0].
+		Output:
+		- class_index. Dict mapping rdflib.URIRef objects to integer indices, also stored in self.ClassIndex.'''
+		main_classes = {cls.storid:ii for ii,cls in enumerate(self.MainClassList)}
+		query = """SELECT resources.iri,objs.o FROM objs JOIN resources ON resources.storid = objs.s
+				WHERE objs.p = ? AND objs.o IN (%s) ORDER BY objs.rowid""" % ",".join("?" * len(main_classes))
+		class_index = {}
+		self.ClassIndex = class_index
+		if (not main_classes):
+			return class_index
+		for iri,onto_class in self.Ontology.world.graph.execute(query,(rdf_type,*main_classes)):
+			class_index.setdefault(rdflib.term.URIRef(iri),main_classes[onto_class])
+		return class_index
+
+	def property_scan(self,prop_iri):
+		'''Fetch all triples for a given property from the quadstore, including those stated through its inverse property,
+		in the same order owlready2 serves them to RDFLib.
+		Input:
+		- prop_iri. String, full IRI of the property.
+		Output:
+		- triples. List of (subject,object,datatype) tuples of storids, with datatype None for object properties.'''
+		world = self.Ontology.world
+		prop_storid = world._abbreviate(prop_iri,False)
+		if (prop_storid is None):
+			return []
+		triples = [(s,o,d) for s,p,o,d in world.graph._get_triples_spod_spod(None,prop_storid,None,None)]
+		onto_prop = world[prop_iri]
+		if (onto_prop is not None and onto_prop._inverse_storid):
+			triples += [(s,o,None) for o,p,s in world.graph._get_obj_triples_spo_spo(None,onto_prop._inverse_storid,None)]
+		return triples
+
+	def step_linker_rule(self):
+		'''Native version of the step_linker query: link every pair of different ReactionSteps sharing a node through
+		isConnectedWith, in both directions, via a hash join of the hasNode triples on the node.
+		Output:
+		- quads. List of (graph,subject,property,object) tuples of storids, to be added to the quadstore'''
+		steps_by_node = {}
+		for step,node,datatype in self.property_scan(rxn_iri + "hasNode"):
+			if (datatype is None):
+				steps_by_node.setdefault(node,set()).add(step)
+		connected = set()
+		for steps in steps_by_node.values():
+			connected.update((stepA,stepB) for stepA in steps for stepB in steps if stepA != stepB)
+		prop_storid = self.Ontology.world._abbreviate(rxn_iri + "isConnectedWith")
+		quads = [(None,stepA,prop_storid,stepB) for stepA,stepB in connected]
+		return quads
+
+	def inchi_mapper_rule(self):
+		'''Native version of the inchi_mapper query: assign to every ChemSpecies the lowest of the InChIs of its calculations,
+		as the MIN aggregate of the SPARQL query does.
+		Output:
+		- quads. List of (graph,subject,property,object,datatype) tuples of storids and values, to be added to the quadstore'''
+		calc_inchis = {}
+		for calc,inchi,datatype in self.property_scan(rxn_iri + "hasInChI"):
+			calc_inchis.setdefault(calc,[]).append((inchi,datatype))
+		species_inchi = {}
+		for spc,calc,datatype in self.property_scan(rxn_iri + "hasCalculation"):
+			for inchi in calc_inchis.get(calc,[]):
+				if (spc not in species_inchi or inchi[0] < species_inchi[spc][0]):
+					species_inchi[spc] = inchi
+		prop_storid = self.Ontology.world._abbreviate(rxn_iri + "hasInChI")
+		quads = [(None,spc,prop_storid,inchi) if datatype is None else (None,spc,prop_storid,inchi,datatype)
+				 for spc,(inchi,datatype) in species_inchi.items()]
+		return quads
+
+	def native_rule_applier(self,rule_list):
+		'''Native alternative to construct_query_applier() for the rules in ontorxn_rules: compute the inferred facts
+		directly from the quadstore and add them in a single batch, giving the same graph as the SPARQL queries.
+		Input:
+		- rule_list. List of strings, keys of ontorxn_rules to be applied in order.'''
+		inference_seq = [getattr(self,ontorxn_rules[rule])() for rule in rule_list]
+		with self.Ontology:
+			for quads in inference_seq:
+				self.Ontology.world._add_quads_with_update(self.Ontology,quads)
+		return None
+
+	def property_closure(self,facts,inverse_pairs,symmetric,transitive):
+		'''Extend in place the sets of (subject,object) storid pairs of object properties until no rule adds new pairs:
+		inverse and symmetric properties, and transitive closure.
+		Input:
+		- facts. Dict mapping property storids to sets of (subject,object) pairs.
+		- inverse_pairs. List of (property,inverse property) storid pairs.
+		- symmetric, transitive. Lists of storids of the symmetric and transitive properties.'''
+		changed = True
+		while (changed):
+			changed = False
+			for prop,inverse in inverse_pairs + [(prop,prop) for prop in symmetric]:
+				new_pairs = {(o,s) for s,o in facts[prop]} - facts[inverse]
+				if (new_pairs):
+					facts[inverse] |= new_pairs
+					changed = True
+			for prop in transitive:
+				# Reachability over the condensation of the property graph: nodes in a cycle also reach their own component
+				G_prop = nx.DiGraph(list(facts[prop]))
+				G_scc = nx.condensation(G_prop)
+				reached = {}
+				for scc in reversed(list(nx.topological_sort(G_scc))):
+					members = G_scc.nodes[scc]["members"]
+					reached[scc] = set()
+					for next_scc in G_scc.successors(scc):
+						reached[scc] |= G_scc.nodes[next_scc]["members"] | reached[next_scc]
+					if (len(members) > 1 or any(G_prop.has_edge(node,node) for node in members)):
+						reached[scc] |= members
+				new_pairs = {(node,target) for scc,targets in reached.items()
+							 for node in G_scc.nodes[scc]["members"] for target in targets}
+				new_pairs -= facts[prop]
+				if (new_pairs):
+					facts[prop] |= new_pairs
+					changed = True
+		return None
+
+	def materialize(self,inferred_iri=None):
+		'''Lightweight alternative to a full DL reasoner, applying in-process only the rules OntoRXN KGs rely on: inverse and
+		symmetric properties, transitive properties (e.g. the connectivity of ReactionSteps, when declared so) and
+		rdf:type assertions from the domain and range of properties. Only the facts that are not yet in the quadstore are
+		added, to a separate ontology that can be saved on its own.
+		Input:
+		- inferred_iri. String, IRI of the ontology holding the inferred facts. If None, that of self.Ontology plus "/inferred#".
+		Output:
+		- inferred. owlready2.Ontology with the inferred facts only, also stored in self.Inferred.'''
+		world = self.Ontology.world
+		graph = world.graph
+		if (not inferred_iri):
+			inferred_iri = self.Ontology.base_iri.rstrip("#/") + "/inferred#"
+		inferred = world.get_ontology(inferred_iri)
+
+		# Property characteristics, from all loaded ontologies
+		def subjects(prop,obj):
+			return [row[0] for row in graph.execute("SELECT s FROM objs WHERE p=? AND o=?",(prop,obj))]
+		object_props = set(subjects(rdf_type,owl_object_property))
+		inverse_pairs = [(s,o) for s,o in graph.execute("SELECT s,o FROM objs WHERE p=?",(owl_inverse_property,))
+						 if s in object_props and o in object_props]
+		inverse_pairs += [(o,s) for s,o in inverse_pairs]
+		symmetric = [prop for prop in subjects(rdf_type,SymmetricProperty.storid) if prop in object_props]
+		transitive = [prop for prop in subjects(rdf_type,TransitiveProperty.storid) if prop in object_props]
+		# Only named classes are used for typing
+		domains = [(s,o) for s,o in graph.execute("SELECT s,o FROM objs WHERE p=?",(rdf_domain,)) if o > 0]
+		ranges = [(s,o) for s,o in graph.execute("SELECT s,o FROM objs WHERE p=?",(rdf_range,))
+				  if o > 0 and s in object_props]
+
+		# Current facts for the involved object properties, and closure
+		rule_props = {prop for pair in inverse_pairs for prop in pair} | set(symmetric) | set(transitive)
+		rule_props |= {prop for prop,cls in domains + ranges if prop in object_props}
+		facts = {prop:set(graph.execute("SELECT s,o FROM objs WHERE p=?",(prop,)).fetchall()) for prop in rule_props}
+		stated = {prop:set(pairs) for prop,pairs in facts.items()}
+		self.property_closure(facts,inverse_pairs,symmetric,transitive)
+		quads = [(inferred.graph.c,s,prop,o) for prop,pairs in facts.items() for s,o in pairs - stated[prop]]
+
+		# Typing from domain and range
+		types = set(graph.execute("SELECT s,o FROM objs WHERE p=?",(rdf_type,)).fetchall())
+		new_types = set()
+		for prop,cls in domains:
+			if (prop in facts):
+				prop_subjects = {s for s,o in facts[prop]}
+			else:
+				prop_subjects = {row[0] for row in graph.execute("SELECT s FROM datas WHERE p=?",(prop,))}
+			new_types.update((s,cls) for s in prop_subjects)
+		for prop,cls in ranges:
+			new_types.update((o,cls) for s,o in facts[prop])
+		quads += [(inferred.graph.c,s,rdf_type,cls) for s,cls in new_types - types]
+
+		world._add_quads_with_update(inferred,quads)
+		print("Materialized %d facts (%d property assertions, %d types)" % (len(quads),len(quads) - len(new_types - types),
+																		  len(new_types - types)))
+		self.Inferred = inferred
+		return inferred
+
 	def nx_graph_generator(self):
 		'''Convenience function to wrap the conversion of a RDFLib world graph to a NetworkX
 		DiGraph'''
@@ -162,28 +647,42 @@ class OntoRXNWrapper:
 		nx.set_node_attributes(self.nxGraph,{node:{prop_name:setting_prop}})
 		return None
 	
-	def collapse_literals(self):
+	def collapse_literals(self,structured=False):
 		'''Check nodes in self.nxGraph that are Literals (corresponding to data properties), set them as
-		attributes of their parent node, under the dataprop property, and remove them from the graph.'''
+		attributes of their parent node, under the dataprop property, and remove them from the graph.
+		Literals are grouped by parent in a single sweep over the edges, so each dataprop is written once.
+		Input:
+		- structured. Boolean, if True dataprop is a list of (property name, value) tuples instead of a string
+		with a PROPERTY:VALUE line per literal.'''
 		print("Originally %d nodes" % len(self.nxGraph.nodes))
-		nodes_to_remove = []
-		for ed in self.nxGraph.edges(data=True):
-			nd1,nd2 = ed[0:2]
+		literal_groups = {}
+		nodes_to_remove = set()
+		for nd1,nd2,ed_data in self.nxGraph.edges(data=True):
 			if (type(nd2) == rdflib.term.Literal):
-				nodes_to_remove.append(nd2)
-				literal_string = ed[2]["name"] + ":" + str(nd2.value)
-				self.set_node_attr_custom(nd1,"dataprop",literal_string)
+				parent,literal = nd1,nd2
 			elif (type(nd1) == rdflib.term.Literal):
-				nodes_to_remove.append(nd1)
-				literal_string = ed[2]["name"] + ":" + str(nd1.value)
-				self.set_node_attr_custom(nd2,"dataprop",literal_string)
-				
-		nodes_to_remove = list(set(nodes_to_remove))
+				parent,literal = nd2,nd1
+			else:
+				continue
+			nodes_to_remove.add(literal)
+			literal_groups.setdefault(parent,[]).append((ed_data["name"],literal.value))
+
+		for parent,literal_list in literal_groups.items():
+			existing_prop = self.nxGraph.nodes[parent].get("dataprop")
+			if (structured):
+				setting_prop = (list(existing_prop) if existing_prop else []) + literal_list
+			else:
+				literal_strings = [name + ":" + str(value) for name,value in literal_list]
+				if (existing_prop):
+					literal_strings.insert(0,existing_prop)
+				setting_prop = "\n".join(literal_strings)
+			self.nxGraph.nodes[parent]["dataprop"] = setting_prop
+
 		print("%d literal nodes to be removed" % len(nodes_to_remove))
 		self.nxGraph.remove_nodes_from(nodes_to_remove)
 		return None
 	
-	def nx_graph_processor(self,blacklist_info={},collapse_literal_flag=True):
+	def nx_graph_processor(self,blacklist_info={},collapse_literal_flag=True,structured_literals=False):
 		'''Process the automatically generated NetworkX graph to simplify manipulation, checking basic
 		rdflib types (URIRefs, BNodes and Literals).
 		typeIds: 1 to general URIRefs, 2, 3, 4 and 5 go for the individuals in each of the OntoRXN main
@@ -193,8 +692,10 @@ class OntoRXNWrapper:
 		strings, to use self.node_type_filter or self.node_string_filter.
 		- collapse_literal_flag. Boolean, if True, transform all nodes corresponding to Literal values to
 		attributes on their parents via self.collapse_literals()
+		- structured_literals. Boolean, if True keep collapsed literals as lists of (property name, value) tuples.
 		'''
 		rdflib_types = [rdflib.term.URIRef,rdflib.term.BNode,rdflib.term.Literal]
+		class_index = self.class_index_builder()
 
 		# Node processing: text, typeId and name for each possible node type
 		for ii,nd in enumerate(self.nxGraph.nodes(data=True)):
@@ -206,14 +707,9 @@ class OntoRXNWrapper:
 				nd[1]["typeId"] = "1"
 				nd[1]["name"] = re.sub("^.*#","",str(nd[0]))
 
-				uri = nd[0]
-				target = self.Ontology.search(iri=uri)
-				try:
-					target_type = target[0].is_a[0]
-					matching_type_ndx = self.MainClassList.index(target_type)
+				matching_type_ndx = class_index.get(nd[0])
+				if (matching_type_ndx is not None):
 					nd[1]["typeId"] = str(matching_type_ndx + 2)
-				except:
-					pass
 				
 			elif (current_type == rdflib.term.BNode):
 				nd[1]["text"] = str(nd[0])
@@ -251,7 +747,8 @@ class OntoRXNWrapper:
 		self.nxGraph.graph["default_state"] = default_state
 
 		# Collapsing literals
-		self.collapse_literals()
+		if (collapse_literal_flag):
+			self.collapse_literals(structured_literals)
 		
 		# Filtering
 		if (blacklist_info):
@@ -265,22 +762,150 @@ class OntoRXNWrapper:
 
 		return None
 	
-	def nx_graph_layout(self,layout_function=nx.spring_layout,passed_positions=[]):
-		'''Assign a layout to the nx.Graph in the self.nxGraph attribute'''
-		if (not passed_positions):
+	def nx_graph_layout(self,layout_function=None,passed_positions=[],cache_dir=None,incremental=True):
+		'''Assign a layout to the nx.Graph in the self.nxGraph attribute.
+		Input:
+		- layout_function. Function taking a nx.Graph and returning a dict of positions, e.g. nx.spring_layout. If None,
+		ontorxn_layout.cached_layout() is used.
+		- passed_positions. Dict of precomputed positions for the nodes. If given, no layout is computed.
+		- cache_dir. String, directory to store layouts in, keyed by the structure of the graph, so the same graph is never
+		laid out twice. If None, layouts are not stored.
+		- incremental. Boolean, if True and a previous layout (self.LastPositions or the closest one stored in cache_dir) shares
+		nodes with the graph, only new nodes are placed.
+		Output:
+		- Sets self.nxGraph.graph["or_positions"] and self.LastPositions'''
+		if (passed_positions):
+			posx = passed_positions
+		elif (layout_function):
 			print("Finding positions for graph with %d nodes" % (len(self.nxGraph.nodes)))
 			posx = layout_function(self.nxGraph)
 		else:
-			posx = passed_positions
+			print("Finding positions for graph with %d nodes" % (len(self.nxGraph.nodes)))
+			cache = ontorxn_layout.LayoutCache(cache_dir) if cache_dir else None
+			posx = ontorxn_layout.cached_layout(self.nxGraph,cache,self.LastPositions,incremental)
 		self.nxGraph.graph["or_positions"] = posx
+		self.LastPositions = {str(nd):pos for nd,pos in posx.items()}
 		return None
 
-	def nx_graph_wrapper(self,blacklist_info,layout_function=None,passed_positions=[]):
+	def nx_graph_wrapper(self,blacklist_info,layout_function=None,passed_positions=[],cache_dir=None):
 		'''Wrapper function to generate a NetworkX graph from the RDFLib graph, processed
 		and including layout'''
 		self.nx_graph_generator()
 		self.nx_graph_processor(blacklist_info)
-		self.nx_graph_layout(layout_function,passed_positions)
+		self.nx_graph_layout(layout_function,passed_positions,cache_dir)
+		return None
+
+class TripleEmitter:
+	'''Buffer to write individuals and their properties straight to the quadstore of an ontology, in batches, without
+	creating owlready2 Python objects for them. All writes go through the transaction of the underlying SQLite connection,
+	which is only committed by World.save(). Individuals are handled by their storid (integer id in the quadstore), and
+	unnamed ones get the same numbered names owlready2 would give them, so the resulting graph is identical to that
+	obtained by instantiating the classes directly.'''
+	def __init__(self,ontology,batch_size=50000):
+		'''Input:
+		- ontology. owlready2.Ontology object where triples are written.
+		- batch_size. Integer, number of buffered triples that triggers a write to the quadstore.'''
+		self.Ontology = ontology
+		self.World = ontology.world
+		self.batch_size = batch_size
+		self.obj_triples = []
+		self.data_triples = []
+		self.resources = []
+		self.counters = {}
+		self.free_storids = iter(())
+
+	def prop(self,property_name):
+		'''Fetch a property by its Python name, as when passing it as keyword or attribute to an individual.
+		Returns None if the property is not defined in the world.'''
+		return self.World._props.get(property_name)
+
+	def storid(self,name):
+		'''Get the storid for the individual with a given name in the ontology, registering the IRI if needed'''
+		return self.World._abbreviate(self.Ontology.base_iri + name)
+
+	def new_storid(self,name):
+		'''Register the IRI of a new individual, taking its storid from a block reserved in the quadstore'''
+		storid = next(self.free_storids,None)
+		if (storid is None):
+			graph = self.World.graph
+			last = graph.execute("UPDATE store SET current_resource=current_resource+?",(self.batch_size,)).execute(
+								 "SELECT current_resource FROM store").fetchone()[0]
+			self.free_storids = iter(range(last - self.batch_size + 1,last + 1))
+			storid = next(self.free_storids)
+		self.resources.append((storid,self.Ontology.base_iri + name))
+		return storid
+
+	def new_name(self,onto_class):
+		'''Generate a numbered name for an unnamed individual of a given class, following owlready2 conventions'''
+		prefix = onto_class.name.lower()
+		counter = self.counters.get(prefix)
+		if (counter is None):
+			iri = self.World._new_numbered_iri(self.Ontology.base_iri + prefix)
+			counter = int(iri[len(self.Ontology.base_iri + prefix):])
+		else:
+			counter += 1
+		self.counters[prefix] = counter
+		return prefix + str(counter)
+
+	def individual(self,onto_class,name=None):
+		'''Declare a named individual of a given class.
+		Input:
+		- onto_class. owlready2 class of the individual.
+		- name. String, name of the individual. If None, a numbered name is generated.
+		Output:
+		- storid. Integer, storid of the individual.'''
+		if (name):
+			storid = self.storid(name)
+		else:
+			storid = self.new_storid(self.new_name(onto_class))
+		self.obj_triples.append((storid,rdf_type,owl_named_individual))
+		self.obj_triples.append((storid,rdf_type,onto_class.storid))
+		self.check_size()
+		return storid
+
+	def add_obj(self,subject,onto_prop,target):
+		'''Add a triple linking two individuals, given by their storids, through an object property'''
+		self.obj_triples.append((subject,onto_prop.storid,target))
+		self.check_size()
+		return None
+
+	def add_data(self,subject,onto_prop,value):
+		'''Add a triple linking an individual, given by its storid, to a literal value through a data or
+		annotation property'''
+		literal,datatype = self.Ontology._to_rdf(value)
+		self.data_triples.append((subject,onto_prop.storid,literal,datatype))
+		self.check_size()
+		return None
+
+	def check_size(self):
+		if (len(self.obj_triples) + len(self.data_triples) + len(self.resources) >= self.batch_size):
+			self.flush()
+		return None
+
+	def flush(self):
+		'''Write all buffered triples to the quadstore'''
+		graph = self.World.graph
+		context = self.Ontology.graph.c
+		graph.acquire_write_lock()
+		try:
+			graph.db.executemany("INSERT INTO resources VALUES (?,?)",self.resources)
+			graph.db.executemany("INSERT OR IGNORE INTO objs VALUES (%d,?,?,?)" % context,self.obj_triples)
+			graph.db.executemany("INSERT OR IGNORE INTO datas VALUES (%d,?,?,?,?)" % context,self.data_triples)
+		finally:
+			graph.release_write_lock()
+		self.obj_triples = []
+		self.data_triples = []
+		self.resources = []
+		return None
+
+	def close(self):
+		'''Write the remaining triples, store the counters for numbered names so owlready2 goes on from them,
+		and refresh the statistics of the quadstore'''
+		self.flush()
+		for prefix,counter in self.counters.items():
+			self.World.graph.execute("UPDATE last_numbered_iri SET i=? WHERE prefix=?",
+									 (counter,self.Ontology.base_iri + prefix))
+		self.World.graph.analyze()
 		return None
 
 def read_property_dict(mapping_file="resources/parsing_rules.dat"):
@@ -412,8 +1037,115 @@ def set_cml_field(calc_onto,cml_dict,property_name,field_info,namespace,track_un
 
 	return None
 
+def atom_emitter(emitter,namespace,geometry_block):
+	'''Bulk counterpart of atom_instantiator(), writing the gc.Molecule and its gc.Atom individuals through a TripleEmitter
+	Input:
+	- emitter. TripleEmitter object for the working ontology.
+	- namespace. Dict with namespace info taken from OntoRXNWrapper.Namespace
+	- geometry_block. String, containing the Cartesian coordinates of a given molecular entity
+	Output:
+	- mol. Integer, storid of the gc.Molecule individual'''
+	gc_space = namespace["gc"]
+	coord_props = [emitter.prop(name) for name in ("hasAtomCoordinateX","hasAtomCoordinateY","hasAtomCoordinateZ")]
+	symbol,has_value,has_atom = [emitter.prop(name) for name in ("symbol","hasValue","hasAtom")]
+	atom_class,value_class = gc_space.Atom,gc_space.FloatValue
+	mol = emitter.individual(gc_space.Molecule)
+	for line in geometry_block.split("\n"):
+		at,x,y,z = line.split()
+		atom = emitter.individual(atom_class)
+		emitter.add_data(atom,symbol,at)
+		for coord_prop,ii in zip(coord_props,[x,y,z]):
+			val = emitter.individual(value_class)
+			emitter.add_data(val,has_value,ii+" a.u.")
+			emitter.add_obj(atom,coord_prop,val)
+		emitter.add_obj(mol,has_atom,atom)
+	return mol
+
+def emit_cml_field(emitter,calc,cml_dict,property_name,field_info,namespace,track_units):
+	'''Bulk counterpart of set_cml_field(), writing the property through a TripleEmitter.
+	Input:
+	- emitter. TripleEmitter object for the working ontology.
+	- calc. Integer, storid of the CompCalculation individual.
+	- cml_dict, property_name, field_info, namespace. As in set_cml_field()
+	- track_units. Dict mapping string unit names with the storids of pre-defined gc.Value instances for them
+	Output:
+	- None, triples are added to the emitter'''
+	gc = namespace["gc"]
+	value_type_dict = {"Float":gc.FloatValue,"Vector":gc.VectorValue}
+
+	onto_prop = emitter.prop(property_name)
+	if (onto_prop is None):
+		# Property undefined in the ontology: cannot assign anything
+		print("%s undefined in the ontology" % property_name)
+		return None
+
+	field_name,field_type,field_unit = field_info
+	field_value = cml_dict.get(field_name)
+
+	if (field_type == "Float" and field_value):
+		field_value = float(field_value)
+
+	raw_unit = bool(re.search("r\".*\"",field_unit))
+	if (raw_unit):
+		unit_value = field_unit[1:].strip("\"")
+	else:
+		unit_value = cml_dict.get(field_unit)
+
+	if (unit_value and unit_value not in track_units.keys()):
+		print("ADDING",unit_value)
+		track_units[unit_value] = emitter.individual(gc.Value,unit_value)
+
+	if (not field_value):
+		return None
+
+	if (field_type == "String"):
+		emitter.add_data(calc,onto_prop,field_value)
+	elif (field_type == "Integer"):
+		emitter.add_data(calc,onto_prop,int(field_value))
+	elif (field_type == "Float" or field_type == "Vector"):
+		target = emitter.individual(value_type_dict[field_type])
+		emitter.add_data(target,emitter.prop("hasValue"),field_value)
+		emitter.add_obj(target,emitter.prop("hasUnit"),track_units[unit_value])
+		result = emitter.individual(gc["CalculationResult"])
+		emitter.add_obj(result,onto_prop,target)
+		emitter.add_obj(calc,emitter.prop("hasResult"),result)
+	return None
+
+def emit_calc(emitter,namespace,property_map_dict,cmldump,cid,calcname,note,track_units):
+	'''Write a CompCalculation individual, with its properties, molecule and initialization module, through a TripleEmitter,
+	generating the same triples as calc_instantiation() does through owlready2 objects.
+	Input:
+	- emitter. TripleEmitter object for the working ontology.
+	- namespace. Dict with namespace info taken from OntoRXNWrapper.Namespace
+	- property_map_dict. Dictionary from read_property_dict()
+	- cmldump. Dictionary for the job of the CML file, from py_iochem.CMLtoPy.xslt_parsing()
+	- cid. Integer, calcId of the calculation.
+	- calcname. String, name of the CompCalculation individual.
+	- note. String, annotation for the individual.
+	- track_units. Dict mapping string unit names with the storids of gc.Value instances
+	Output:
+	- compcalc. Integer, storid of the CompCalculation individual'''
+	gc = namespace["gc"]
+	occ = namespace["occ"]
+	onto = namespace["onto"]
+	compcalc = emitter.individual(onto["CompCalculation"],calcname)
+	emitter.add_data(compcalc,emitter.prop("hasAnnotation"),note)
+	for k,v in property_map_dict.items():
+		emit_cml_field(emitter,compcalc,cmldump,k,v,namespace,track_units)
+	mol = atom_emitter(emitter,namespace,cmldump["geometry"])
+	emitter.add_obj(compcalc,emitter.prop("hasMolecule"),mol)
+	init = emitter.individual(occ["InitializationModule"],"init_%d" % cid)
+	emitter.add_obj(compcalc,emitter.prop("hasInitialization"),init)
+	basis = emitter.individual(gc["BasisSet"],"basis_set_%d" % cid)
+	emitter.add_data(basis,emitter.prop("hasBasisSet"),cmldump["basis"])
+	level = emitter.individual(occ["LevelOfTheory"],"level_of_theory_%d" % cid)
+	emitter.add_data(level,emitter.prop("hasLevelOfTheory"),cmldump["method"])
+	for param in (basis,level):
+		emitter.add_obj(init,emitter.prop("hasParameter"),param)
+	return compcalc
+
 # Go through calculations and instantiate CompCalculation & ChemSpecies entities
-def calc_instantiation(onto_manager,calcinfo,report_id):
+def calc_instantiation(onto_manager,calcinfo,report_id,nprocs=None,cache=None,bulk=False,batch_size=50000):
 	'''Generate all CompCalculation and ChemSpecies individuals required for a Reaction Energy Profile report.
 	Information is fetched from the CML files named according to every calcId in the profile.
 	ChemSpecies are generated by the unique names of these calculations.
@@ -422,6 +1154,11 @@ def calc_instantiation(onto_manager,calcinfo,report_id):
 	- calcinfo. List of dicts containing calculation information as obtained from the JSON dump of ReportHandler.get_report_calcs()
 	- namespaces. Dict matching string tags to valid namespaces to be used in the ontology. Must contain "gc" mapping to Gainesville Core.
 	- report_id. Integer, ID of the report used in KG generation (to build stage and step IDs)
+	- nprocs. Integer, number of processes used to parse the CML files. If None, use all available CPUs.
+	- cache. py_iochem.CMLCache object to reuse parsed CML files. If None, all files are parsed.
+	- bulk. Boolean, if True write all individuals straight to the quadstore through a TripleEmitter, in batches, instead of
+	creating owlready2 objects one by one. The resulting graph is the same.
+	- batch_size. Integer, number of triples per batch in bulk mode.
 	Output:
 	- track_calcs. Dictionary matching cN indices (based on calcOrder) to the unique identifiers generated for CompCalculation objects in the KG.
 	- track_species. Dictionary matching cN indices (based on calcOrder) to the unique identifiers generated for ChemSpecies objects in the KG.
@@ -438,33 +1175,45 @@ def calc_instantiation(onto_manager,calcinfo,report_id):
 	track_species = {}
 	molecule_names = {}
 	track_units = {}
-	for calc in calcinfo:
+	# Parse all CML files beforehand, in parallel: consider only the 2nd job by now (frequency job!)
+	cmlfiles = ["calc_%d.cml" % calc["calcId"] for calc in calcinfo]
+	cmlfields,cmlerrors = cml.batch_xslt_parsing(cmlfiles,nprocs=nprocs,cache=cache,jobs=[1])
+	if (cmlerrors):
+		for cmlfile,error in cmlerrors.items():
+			print("Could not parse %s (%s)" % (cmlfile,error))
+		raise RuntimeError("CML parsing failed for %d files" % len(cmlerrors))
+	emitter = None
+	if (bulk):
+		emitter = TripleEmitter(onto_manager.Ontology,batch_size)
+	for calc,cmlfull in zip(calcinfo,cmlfields):
 		# Extract properties
 		cid = calc["calcId"]
 		molname = calc["title"]
 		cN = "c%d" % calc["calcOrder"]
-		cmlfile = "calc_%d.cml" % cid
 		# Entity instantiation
 		calcname = "CALC_%d" % cid
-		compcalc = onto_manager.Ontology["CompCalculation"](calcname,namespace=onto_manager.Ontology)
 		note = "%s;c%d;%d" % (molname,calc["calcOrder"],cid)
-		compcalc.hasAnnotation.append(note)
-		# Fetch properties from the CML file and add them to the individual: consider only the 2nd item by now (frequency job!)
-		cmldump = cml.xslt_parsing(cmlfile)[1]
-		# Basic properties, direct assignment
-		for k,v in property_map_dict.items():
-			set_cml_field(calc_onto=compcalc,cml_dict=cmldump,property_name=k,
-						  field_info=v,namespace=onto_manager.Namespace,track_units=track_units)
-		# More complex properties: initialization object, molecule...
-		mol = atom_instantiator(onto_manager,cmldump["geometry"])
-		compcalc.hasMolecule.append(mol)
-		init = occ["InitializationModule"]("init_%d" % cid,namespace=onto_manager.Ontology)
-		compcalc.hasInitialization = [init]
-		basis = gc["BasisSet"]("basis_set_%d" % cid,namespace=onto_manager.Ontology,
-							   hasBasisSet=cmldump["basis"])
-		level = occ["LevelOfTheory"]("level_of_theory_%d" % cid,namespace=onto_manager.Ontology)
-		level.hasLevelOfTheory = [cmldump["method"]]
-		init.hasParameter = [basis,level]
+		# Fetch properties from the CML file and add them to the individual
+		cmldump = cmlfull[0]
+		if (emitter):
+			compcalc = emit_calc(emitter,onto_manager.Namespace,property_map_dict,cmldump,cid,calcname,note,track_units)
+		else:
+			compcalc = onto_manager.Ontology["CompCalculation"](calcname,namespace=onto_manager.Ontology)
+			compcalc.hasAnnotation.append(note)
+			# Basic properties, direct assignment
+			for k,v in property_map_dict.items():
+				set_cml_field(calc_onto=compcalc,cml_dict=cmldump,property_name=k,
+							  field_info=v,namespace=onto_manager.Namespace,track_units=track_units)
+			# More complex properties: initialization object, molecule...
+			mol = atom_instantiator(onto_manager,cmldump["geometry"])
+			compcalc.hasMolecule.append(mol)
+			init = occ["InitializationModule"]("init_%d" % cid,namespace=onto_manager.Ontology)
+			compcalc.hasInitialization = [init]
+			basis = gc["BasisSet"]("basis_set_%d" % cid,namespace=onto_manager.Ontology,
+								   hasBasisSet=cmldump["basis"])
+			level = occ["LevelOfTheory"]("level_of_theory_%d" % cid,namespace=onto_manager.Ontology)
+			level.hasLevelOfTheory = [cmldump["method"]]
+			init.hasParameter = [basis,level]
 		# Save to dictionary for tracking
 		track_calcs[cN] = calcname
 		# Species: check whether the "name" of the calculation has yet been observed or not
@@ -476,16 +1225,28 @@ def calc_instantiation(onto_manager,calcinfo,report_id):
 			spcname = track_species[code]
 			# And link with the corresponding calculation
 			calcname = track_calcs[cN]
-			onto_manager.Ontology[spcname].hasCalculation.append(onto_manager.Ontology[calcname])
-			onto_manager.Ontology[spcname].hasAnnotation.append(cN)
+			if (emitter):
+				spc = emitter.storid(spcname)
+				emitter.add_obj(spc,emitter.prop("hasCalculation"),compcalc)
+				emitter.add_data(spc,emitter.prop("hasAnnotation"),cN)
+			else:
+				onto_manager.Ontology[spcname].hasCalculation.append(onto_manager.Ontology[calcname])
+				onto_manager.Ontology[spcname].hasAnnotation.append(cN)
 		else:
 			molecule_names[molname] = [cN]
 			spcid = "%d-spc-%d" % (report_id,calc["calcOrder"])
 			spcname = "SPC_%s" % spcid
-			spc = onto_manager.Ontology["ChemSpecies"](spcname,namespace=onto_manager.Ontology,hasCalculation=[compcalc])
-			spc.hasAnnotation.append(cN)
+			if (emitter):
+				spc = emitter.individual(onto_manager.Ontology["ChemSpecies"],spcname)
+				emitter.add_obj(spc,emitter.prop("hasCalculation"),compcalc)
+				emitter.add_data(spc,emitter.prop("hasAnnotation"),cN)
+			else:
+				spc = onto_manager.Ontology["ChemSpecies"](spcname,namespace=onto_manager.Ontology,hasCalculation=[compcalc])
+				spc.hasAnnotation.append(cN)
 		# In any case, match the cN code with the name of the individual
 		track_species[cN] = spcname
+	if (emitter):
+		emitter.close()
 	return track_calcs,track_species
 
 def stage_generator(onto_manager,stg_id,element,spc_dict=None):
@@ -559,50 +1320,93 @@ def structure_generator(onto_manager,G_list,track_species,report_id):
 		return track_stages
 
 def knowledge_graph_gen(ontology_route,report_id,config_file,graph_file,out_file,
-						collapse_graph=False,fetch_files=False,use_reasoner=False):
+						collapse_graph=False,fetch_files=False,use_reasoner=False,nprocs=None,
+						cache_file=None,sync_files=False,record_dir=None,replay_dir=None,
+						world_file=None,cache_size=None,bulk_triples=False,native_inference=False,
+						materialize=False,overwrite=False):
 	'''Wrapper for KG generation based on OntoRXN from an ioChem-BD report.
 	Input:
 	- ontology_route. String, full path for the current OntoRXN instance.
 	- report_id. Integer, ID for the report in ioChem-BD containing the information for the KG.
 	- config_file. String, name of the INI-like file containing login data and URLs for the REST API.
 	- graph_file. String, name of the DOT file with the ioChem-BD-generated graph.
-	- out_file. String, name of the OWL file to be generated.
+	- out_file. String, name of the file to be generated: RDF/XML (.owl) or N-Triples, possibly compressed (.nt, .nt.gz, .nt.zst)
 	- collapse_graph. Boolean, if True contract nodes with the same name when reading the graph.
 	- fetch_files. Boolean, if True download the CML files assigned to the report in ioCHem-BD.
 	- use_reasoner. Boolean, if True apply the default reasoner in owlready2 to the KG.
+	- nprocs. Integer, number of processes used to parse the CML files. If None, use all available CPUs.
+	- cache_file. String, name of the SQLite file used to cache parsed CML files between runs. If None, no cache is used.
+	- sync_files. Boolean, if True download only the CML files that are new or changed since the last run, tracked in a local manifest.
+	- record_dir. String, directory where all REST API responses are recorded, to be replayed later.
+	- replay_dir. String, directory with recorded REST API responses, served instead of contacting ioChem-BD.
+	- world_file. String, name of a SQLite file to hold the quadstore on disk instead of in memory. It can be reopened
+	later with OntoRXNWrapper.load_KG(world_file=world_file).
+	- cache_size. Integer, size in MB of the SQLite page cache for world_file.
+	- bulk_triples. Boolean, if True write CompCalculation individuals and their contents to the quadstore in bulk.
+	- native_inference. Boolean, if True compute the facts in ontorxn_queries natively (ontorxn_rules) instead of through SPARQL.
+	- materialize. Boolean, if True apply the lightweight OntoRXN rules of OntoRXNWrapper.materialize() and save only the
+	inferred facts to a separate OWL file.
+	- overwrite. Boolean, if True remove world_file if it already exists. Otherwise, an existing world_file raises
+	FileExistsError before any work is done.
 	Output:
 	- onto_manager. OntoRXNWrapper object with the ontology and additional properties.
-	- Generates OWL files for the KG and possibly the KG with inferred facts after reasoning.'''
+	- Generates OWL or N-Triples files for the KG and possibly the KG with inferred facts after reasoning, or the inferred
+	facts alone after materialization.'''
+
+	# Never remove a previous quadstore unless requested
+	if (world_file and os.path.isfile(world_file) and not overwrite):
+		raise FileExistsError("World file %s already exists, use overwrite=True to replace it" % world_file)
 
 	### 1. Read the graph (DOT format) and fetch report information (REST API)
 	G_list = GraphManager.graph_read_split(graph_file,collapse_nodes=collapse_graph)
-	report = ReportHandler(report_id=report_id,config_file=config_file)
+	report = ReportHandler(report_id=report_id,config_file=config_file,record_dir=record_dir,replay_dir=replay_dir)
 
 	# Fetch all properties in the report and map the corresponding formulas to the list of graphs
 	properties,calcs = report.report_dump()
 	GraphManager.formula_mapper(G_list,properties)
 
 	# Handle files, with default naming scheme calc_CID.cml
-	if (fetch_files):
+	if (sync_files):
+		report.sync_cml_files()
+	elif (fetch_files):
 		report.batch_cml_dump()
+	report.close()
 
 	### 2. Ontology management
 	# Load our ontology (from local file) and the imports from their default IRI-based names from onto_path
 	onto_manager = OntoRXNWrapper()
-	onto_manager.load_ontorxn(ontology_route)
+	if (overwrite and world_file and os.path.isfile(world_file)):
+		os.remove(world_file)
+	onto_manager.load_ontorxn(ontology_route,world_file,cache_size)
 	### 3. Generate the KG
 	### 3.1 Take calcs and species from the report
-	track_calcs,track_species = calc_instantiation(onto_manager,calcs,report_id)
+	cache = None
+	if (cache_file):
+		cache = CMLCache(cache_file)
+	track_calcs,track_species = calc_instantiation(onto_manager,calcs,report_id,nprocs,cache,bulk_triples)
+	if (cache):
+		print("CML cache: %d hits, %d misses" % (cache.hits,cache.misses))
+		cache.close()
 	### 3.2 Generate stages and steps (structure) from the list of graphs
 	track_stages = structure_generator(onto_manager,G_list,track_species,report_id)
-	### 3.3 Apply SPARQL queries via RDFLib
-	onto_manager.construct_query_applier(list(ontorxn_queries.values()))
-	onto_manager.Ontology.save(out_file)
+	### 3.3 Apply SPARQL queries via RDFLib, or their native counterparts
+	if (native_inference):
+		onto_manager.native_rule_applier(list(ontorxn_rules.keys()))
+	else:
+		onto_manager.construct_query_applier(list(ontorxn_queries.values()))
+	onto_manager.save_world()
+	onto_manager.save_KG(out_file)
+	# Optional rule-based materialization, keeping only the new facts
+	if (materialize):
+		inferred = onto_manager.materialize()
+		onto_manager.save_world()
+		onto_manager.save_KG(suffixed_filename(out_file,"_delta"),inferred)
 	# Optional inference from the default reasoner
 	if (use_reasoner):
 		with onto_manager.Ontology:
 			print("Start reasoner")
-			sync_reasoner()
-			alt_out_file = out_file.replace(".owl","_inferred.owl")
-			onto_manager.Ontology.save(alt_out_file)
+			sync_reasoner(onto_manager.World)
+			alt_out_file = suffixed_filename(out_file,"_inferred")
+			onto_manager.save_world()
+			onto_manager.save_KG(alt_out_file)
 	return onto_manager
@@ -0,0 +1,97 @@
+'''Persistent cache for the dictionaries generated from CML files by CMLtoPy, stored in a single
+SQLite file. Entries are addressed by hashes of the contents of the CML file and the stylesheet used
+to parse it, so unchanged files are never parsed twice, and the least recently used entries are
+evicted when the cache grows over a given size.'''
+
+import sqlite3
+import json
+import time
+
+class CMLCache:
+	'''Content-addressed SQLite store for parsed CML files'''
+	def __init__(self,db_file="cml_cache.sqlite",max_size=512*1024**2):
+		'''Input:
+		- db_file. String, name of the SQLite file holding the cache. It is created if it does not exist.
+		- max_size. Integer, maximum size in bytes of the stored entries. Least recently used entries are
+		removed when this size is exceeded.'''
+		self.db_file = db_file
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		# Access times of cache hits, written in a single transaction by self.flush()
+		self.pending_access = {}
+		self.connection = sqlite3.connect(db_file)
+		self.connection.execute('''CREATE TABLE IF NOT EXISTS parsed_cml
+								(key TEXT PRIMARY KEY, fields TEXT, size INTEGER, last_access REAL)''')
+		self.connection.commit()
+
+	def get(self,key):
+		'''Fetch the parsed fields for a given key.
+		Input:
+		- key. String, hash-based key as generated by CMLtoPy.parsing_key()
+		Output:
+		- fields. List of dicts as generated by CMLtoPy.xslt_parsing(), or None if the key is not stored.'''
+		row = self.connection.execute("SELECT fields FROM parsed_cml WHERE key = ?",(key,)).fetchone()
+		if (not row):
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.pending_access[key] = time.time()
+		return json.loads(row[0])
+
+	def put(self,key,fields):
+		'''Store the parsed fields for a given key, evicting old entries if needed.
+		Input:
+		- key. String, hash-based key as generated by CMLtoPy.parsing_key()
+		- fields. List of dicts as generated by CMLtoPy.xslt_parsing()'''
+		fields_json = json.dumps(fields)
+		self.connection.execute("INSERT OR REPLACE INTO parsed_cml VALUES (?,?,?,?)",
+								(key,fields_json,len(fields_json),time.time()))
+		self.connection.commit()
+		self.evict()
+		return None
+
+	def flush(self):
+		'''Write the access times of all pending cache hits at once, so that warm runs do not commit once per file'''
+		if (not self.pending_access):
+			return None
+		self.connection.executemany("UPDATE parsed_cml SET last_access = ? WHERE key = ?",
+									[(access,key) for key,access in self.pending_access.items()])
+		self.connection.commit()
+		self.pending_access = {}
+		return None
+
+	def size(self):
+		'''Total size, in bytes, of the stored entries'''
+		total = self.connection.execute("SELECT COALESCE(SUM(size),0) FROM parsed_cml").fetchone()[0]
+		return total
+
+	def evict(self):
+		'''Remove the least recently used entries until the stored size is below self.max_size'''
+		self.flush()
+		excess = self.size() - self.max_size
+		if (excess <= 0):
+			return None
+		rows = self.connection.execute("SELECT key,size FROM parsed_cml ORDER BY last_access")
+		removed_keys = []
+		for key,size in rows:
+			if (excess <= 0):
+				break
+			removed_keys.append((key,))
+			excess -= size
+		self.connection.executemany("DELETE FROM parsed_cml WHERE key = ?",removed_keys)
+		self.connection.commit()
+		return None
+
+	def clear(self):
+		'''Remove all entries in the cache'''
+		self.connection.execute("DELETE FROM parsed_cml")
+		self.connection.commit()
+		self.pending_access = {}
+		return None
+
+	def close(self):
+		'''Write pending access times and close the connection to the SQLite file'''
+		self.flush()
+		self.connection.close()
+		return None
@@ -2,11 +2,17 @@
 Processing of the CML files generated by ioChem-BD to generate Python dictionaries,
 based on XSLT stylesheets.
 Default stylesheets for some programs are provided in ../stylesheets, but custom ones
-can also be provided.'''
+can also be provided.
+Alternatively, fields can be extracted directly through precompiled XPath expressions, skipping
+the intermediate text output of the XSLT transformation.'''
 
 import lxml.etree as ET
 import os.path
 import importlib.util
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+cml_namespaces = {"cml":"http://www.xml-cml.org/schema"}
 
 def process_xslt_entry(xslt_string,main_separator="#;#"):
 	'''Process a single cc:job entry in a CML file, transforming it to a plain text string
@@ -38,26 +44,374 @@ def process_xslt_output(batch_xslt_string,job_separator="FETCH_JOB_END\n"):
 	proc_job_entries = [process_xslt_entry(entry) for entry in job_entries]
 	return proc_job_entries
 
-def xslt_parsing(cml_file,custom_template=False,xslt_template="stylesheets/CML_Gaussian.xsl"):
-	'''Direct parsing of CML files via XSLT stylesheets. By default resorts to the ../stylesheets
-	folder containing default templates, but a custom XSL can also be passed.
+# Registry of compiled XSLT stylesheets, mapping absolute paths to (mtime,ET.XSLT) tuples, so every
+# stylesheet is only parsed and compiled once per process
+xslt_registry = {}
+
+# Default stylesheets (relative to the parent of the module) for every program, as named in the
+# cc:program parameter of the CML. Keys are lowercase and matched against the start of the program name
+program_stylesheets = {
+	"gaussian":"stylesheets/CML_Gaussian.xsl"
+}
+default_program = "gaussian"
+
+def stylesheet_path(xslt_template,custom_template=False):
+	'''Resolve the route to a XSL stylesheet, either relative to the parent of the module (default templates)
+	or as passed (custom templates).
 	Input:
-	- cml_file. String, name of the CML file to be parsed.
-	- custom_template. Boolean, if True do not check the default directory but the path to the requested file,
-	else consider the path parent to the module.
 	- xslt_template. String, path to the XSL stylesheet.
+	- custom_template. Boolean, if True take the path as given, else consider the path parent to the module.
 	Output:
-	- job_cml_fields. List of dicts as generated by process_xslt_entry for each cc:job, containing key:value
-	pairs for all the fields requested by the XSLT, with all values being strings.'''
-	base_dir = os.path.dirname(__file__)
+	- xslt_path. String, absolute path to the XSL stylesheet.'''
 	if (not custom_template):
 		# go one level above with another dirname call
-		xslt_path = os.path.dirname(base_dir) + "/" + xslt_template
+		base_dir = os.path.dirname(os.path.dirname(__file__))
+		xslt_path = base_dir + "/" + xslt_template
 	else:
 		xslt_path = xslt_template
-	doc = ET.parse(cml_file)
+	return os.path.abspath(xslt_path)
+
+def get_stylesheet(xslt_path):
+	'''Fetch a compiled XSLT transformation from the registry, compiling the stylesheet if it had not
+	been loaded yet or if the file was modified after the last compilation.
+	Input:
+	- xslt_path. String, path to the XSL stylesheet.
+	Output:
+	- transform. ET.XSLT object for the stylesheet.'''
+	xslt_path = os.path.abspath(xslt_path)
+	mtime = os.path.getmtime(xslt_path)
+	entry = xslt_registry.get(xslt_path)
+	if (entry and entry[0] == mtime):
+		return entry[1]
 	transform = ET.XSLT(ET.parse(xslt_path))
+	xslt_registry[xslt_path] = (mtime,transform)
+	return transform
+
+def detect_program(doc):
+	'''Read the name of the program that generated a CML document, from its cc:program parameter.
+	Input:
+	- doc. ET.ElementTree or ET.Element for the parsed CML document.
+	Output:
+	- program. String, name of the program (e.g. Gaussian), or None if it is not specified.'''
+	program_list = doc.xpath("//cml:parameter[@dictRef='cc:program']/cml:scalar/text()",
+							 namespaces=cml_namespaces)
+	if (not program_list):
+		return None
+	return program_list[0].strip()
+
+def select_stylesheet(doc):
+	'''Choose the default stylesheet for a CML document according to the program that generated it,
+	falling back to the stylesheet of default_program when the program is missing or unknown.
+	Input:
+	- doc. ET.ElementTree or ET.Element for the parsed CML document.
+	Output:
+	- xslt_path. String, absolute path to the selected XSL stylesheet.'''
+	program = detect_program(doc)
+	xslt_template = program_stylesheets[default_program]
+	if (program):
+		for prog_key,prog_template in program_stylesheets.items():
+			if (program.lower().startswith(prog_key)):
+				xslt_template = prog_template
+				break
+	return stylesheet_path(xslt_template)
+
+def stream_jobs(cml_file,jobs):
+	'''Read only the requested cc:job entries of a CML file, streaming the document via iterparse and clearing
+	all other jobs as they are read, so memory usage is bounded by the size of the kept jobs.
+	Input:
+	- cml_file. String, name of the CML file to be read.
+	- jobs. Integer or list of integers, 0-based indices of the cc:job entries to keep.
+	Output:
+	- doc. ET.ElementTree with a cc:jobList module containing only the requested jobs, in document order.
+	Raises IndexError if any of the requested jobs is not present in the file.'''
+	if (isinstance(jobs,int)):
+		jobs = [jobs]
+	pending_jobs = set(jobs)
+	module_tag = "{%s}module" % cml_namespaces["cml"]
+	root = ET.Element(module_tag,nsmap={None:cml_namespaces["cml"]})
+	job_list = ET.SubElement(root,module_tag,dictRef="cc:jobList")
+	job_counter = 0
+	for event,elem in ET.iterparse(cml_file,events=("end",),tag=module_tag):
+		if (elem.get("dictRef") != "cc:job"):
+			continue
+		parent = elem.getparent()
+		if (job_counter in pending_jobs):
+			# detach the job from the streamed tree and keep it
+			parent.remove(elem)
+			job_list.append(elem)
+			pending_jobs.discard(job_counter)
+		else:
+			elem.clear()
+			# also drop the already processed siblings
+			while (elem.getprevious() is not None):
+				del parent[0]
+		job_counter += 1
+		if (not pending_jobs):
+			break
+	if (pending_jobs):
+		raise IndexError("cc:job indices %s not found in %s, which has %d jobs" % (sorted(pending_jobs),cml_file,job_counter))
+	return ET.ElementTree(root)
+
+def file_digest(filename,chunk_size=1024**2):
+	'''SHA-256 hex digest of the contents of a file, read in chunks'''
+	digest = hashlib.sha256()
+	with open(filename,"rb") as fhash:
+		for chunk in iter(lambda: fhash.read(chunk_size),b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def parsing_key(cml_file,custom_template=False,xslt_template=None,jobs=None):
+	'''Build a content-based key for the parsing of a CML file, to be used in CMLCache.CMLCache, hashing
+	the CML file and the stylesheet. If no stylesheet is given, all the default ones in program_stylesheets are
+	hashed, as the choice depends on the contents of the CML.
+	Input:
+	- cml_file, custom_template, xslt_template, jobs. As in xslt_parsing()
+	Output:
+	- key. String, hex digest identifying the CML file, the stylesheet(s) and the selected jobs.'''
+	if (xslt_template):
+		xslt_paths = [stylesheet_path(xslt_template,custom_template)]
+	else:
+		xslt_paths = sorted(set([stylesheet_path(templ) for templ in program_stylesheets.values()]))
+	digest = hashlib.sha256(file_digest(cml_file).encode())
+	for xslt_path in xslt_paths:
+		digest.update(file_digest(xslt_path).encode())
+	if (jobs is not None):
+		digest.update(("jobs:%s" % jobs).encode())
+	return digest.hexdigest()
+
+def xslt_parsing(cml_file,custom_template=False,xslt_template=None,cache=None,jobs=None):
+	'''Direct parsing of CML files via XSLT stylesheets. By default resorts to the ../stylesheets
+	folder containing default templates, choosing the one matching the program in the CML, but a custom XSL
+	can also be passed. Stylesheets are compiled once and kept in xslt_registry.
+	Input:
+	- cml_file. String, name of the CML file to be parsed.
+	- custom_template. Boolean, if True do not check the default directory but the path to the requested file,
+	else consider the path parent to the module.
+	- xslt_template. String, path to the XSL stylesheet. If None, select it from program_stylesheets according
+	to the program in the CML file.
+	- cache. CMLCache.CMLCache object to fetch previously parsed results from and store new ones. If None,
+	always parse the file.
+	- jobs. Integer or list of integers, 0-based indices of the cc:job entries to parse. If passed, the file is
+	streamed via stream_jobs() and all other jobs are discarded. If None, the whole document is parsed.
+	Output:
+	- job_cml_fields. List of dicts as generated by process_xslt_entry for each cc:job (or for every requested
+	job), containing key:value pairs for all the fields requested by the XSLT, with all values being strings.'''
+	if (cache):
+		key = parsing_key(cml_file,custom_template,xslt_template,jobs)
+		job_cml_fields = cache.get(key)
+		if (job_cml_fields is not None):
+			return job_cml_fields
+	if (jobs is not None):
+		doc = stream_jobs(cml_file,jobs)
+	else:
+		doc = ET.parse(cml_file)
+	if (xslt_template):
+		xslt_path = stylesheet_path(xslt_template,custom_template)
+	else:
+		xslt_path = select_stylesheet(doc)
+	transform = get_stylesheet(xslt_path)
 	doc_transf = transform(doc)
 	string_output = str(doc_transf)
 	job_cml_fields = process_xslt_output(string_output)
+	if (cache):
+		cache.put(key,job_cml_fields)
+	return job_cml_fields
+
+def safe_xslt_parsing(cml_file,custom_template=False,xslt_template=None,jobs=None):
+	'''Wrapper over xslt_parsing() that catches errors instead of raising them, to be used on batch parsing.
+	Input:
+	- cml_file, custom_template, xslt_template, jobs. As in xslt_parsing()
+	Output:
+	- job_cml_fields. List of dicts as generated by xslt_parsing(), or None if parsing failed.
+	- error. String describing the error, or None if parsing succeeded.'''
+	try:
+		job_cml_fields = xslt_parsing(cml_file,custom_template,xslt_template,jobs=jobs)
+	except Exception as exc:
+		return None,"%s: %s" % (type(exc).__name__,exc)
+	return job_cml_fields,None
+
+def batch_xslt_parsing(cml_files,nprocs=None,custom_template=False,xslt_template=None,cache=None,jobs=None):
+	'''Parse a list of CML files via xslt_parsing(), distributing the files over a pool of worker processes.
+	Input:
+	- cml_files. List of strings, names of the CML files to be parsed.
+	- nprocs. Integer, number of worker processes. If None, use all available CPUs. If 1, parse serially
+	in the current process.
+	- custom_template, xslt_template, jobs. As in xslt_parsing()
+	- cache. CMLCache.CMLCache object. If passed, only files missing in the cache are parsed, and their results
+	are then stored in it.
+	Output:
+	- batch_fields. List with the output of xslt_parsing() for every file, in the same order as cml_files.
+	Files that could not be parsed get None.
+	- batch_errors. Dict mapping the names of the files that could not be parsed to error descriptions.'''
+	cml_files = list(cml_files)
+	results = [None]*len(cml_files)
+	# Check the cache first: only the missing files go to the pool
+	cache_keys = {}
+	if (cache):
+		for ii,fn in enumerate(cml_files):
+			try:
+				cache_keys[ii] = parsing_key(fn,custom_template,xslt_template,jobs)
+			except OSError as exc:
+				results[ii] = (None,"%s: %s" % (type(exc).__name__,exc))
+				continue
+			cached_fields = cache.get(cache_keys[ii])
+			if (cached_fields is not None):
+				results[ii] = (cached_fields,None)
+	pending = [ii for ii,res in enumerate(results) if res is None]
+	pending_files = [cml_files[ii] for ii in pending]
+	Npending = len(pending_files)
+	templ_args = ([custom_template]*Npending,[xslt_template]*Npending,[jobs]*Npending)
+	if (nprocs == 1 or Npending <= 1):
+		parsed = list(map(safe_xslt_parsing,pending_files,*templ_args))
+	else:
+		with ProcessPoolExecutor(max_workers=nprocs) as executor:
+			parsed = list(executor.map(safe_xslt_parsing,pending_files,*templ_args))
+	for ii,res in zip(pending,parsed):
+		results[ii] = res
+		if (cache and res[0] is not None):
+			cache.put(cache_keys[ii],res[0])
+	batch_fields = [res[0] for res in results]
+	batch_errors = {fn:res[1] for fn,res in zip(cml_files,results) if res[1]}
+	return batch_fields,batch_errors
+
+# Direct XPath-based extraction, without the XSLT-to-string step
+job_xpath = "//cml:module[@dictRef='cc:jobList']/cml:module[@dictRef='cc:job']"
+atom_xpath = ET.XPath("cml:module[@dictRef='cc:finalization']/cml:molecule/cml:atomArray/cml:atom",
+					  namespaces=cml_namespaces)
+
+def xpath_geometry(job):
+	'''Build the XYZ-like geometry block (one "element x y z" line per atom) for a cc:job element, as done by
+	the getMolecule template in the XSL stylesheets.
+	Input:
+	- job. ET.Element for a cc:job module.
+	Output:
+	- geometry. String with the Cartesian coordinates of the final molecule.'''
+	atom_lines = [" ".join([at.get(key,"") for key in ("elementType","x3","y3","z3")])
+				  for at in atom_xpath(job)]
+	return "\n".join(atom_lines)
+
+# Fields for Gaussian CML files, mirroring CML_Gaussian.xsl. Values are XPath expressions relative to the cc:job
+# element, returning strings, or functions taking the cc:job element for fields that cannot be built from a single expression
+gaussian_xpath_fields = {
+	"method":"string((.//cml:parameter[@dictRef='cc:method']/cml:scalar)[1])",
+	"basis":"string((.//cml:parameter[@dictRef='cc:basis']/cml:scalar)[1])",
+	"op":"string((.//cml:parameter[@dictRef='g:operation']/cml:scalar)[1])",
+	"solvent":"string((.//cml:scalar[@dictRef='g:solvent'])[1])",
+	"solvEps":"string((.//cml:scalar[@dictRef='g:eps'])[1])",
+	"energy":"string((.//cml:module[@dictRef='cc:finalization']//cml:scalar[@dictRef='cc:hfenergy'])[1])",
+	"energyUnits":"translate((.//cml:module[@dictRef='cc:finalization']//cml:scalar[@dictRef='cc:hfenergy'])[1]/@units,':','_')",
+	"G":"string((.//cml:scalar[@dictRef='cc:zpe.sumelectthermalfe'])[1])",
+	"gibbsUnits":"translate((.//cml:scalar[@dictRef='cc:zpe.sumelectthermalfe'])[1]/@units,':','_')",
+	"temp":"string((.//cml:scalar[@dictRef='cc:temp'])[1])",
+	"tempUnits":"translate((.//cml:scalar[@dictRef='cc:temp'])[1]/@units,':','_')",
+	"pressure":"string((.//cml:scalar[@dictRef='cc:press'])[1])",
+	"pressUnits":"translate((.//cml:scalar[@dictRef='cc:press'])[1]/@units,':','_')",
+	"symmnumb":"string((.//cml:scalar[@dictRef='cc:symmnumber'])[1])",
+	"rottemp":"string((.//cml:array[@dictRef='cc:rottemp'])[1])",
+	"mominertia":"string((.//cml:array[@dictRef='cc:moi.eigenvalues'])[1])",
+	"molmass":"string((.//cml:scalar[@dictRef='cc:molmass'])[1])",
+	"geometry":xpath_geometry,
+	"inchi":"string((.//cml:module[@dictRef='cc:finalization']/cml:molecule/cml:formula[@convention='iupac:inchi'])[1]/@inline)",
+	"frequencies":"string((.//cml:array[@dictRef='cc:frequency'])[1])",
+	"freqUnits":"'cm-1'"
+}
+
+program_xpath_fields = {
+	"gaussian":gaussian_xpath_fields
+}
+
+# Registry of compiled XPath field sets, mapping program keys to (job XPath, dict of compiled fields) tuples
+xpath_registry = {}
+
+def compile_xpath_fields(xpath_fields):
+	'''Precompile a set of XPath field definitions.
+	Input:
+	- xpath_fields. Dict mapping field names to XPath expressions (strings) or functions taking a cc:job element.
+	Output:
+	- compiled_fields. Dict mapping field names to callables taking a cc:job element.'''
+	compiled_fields = {}
+	for name,expr in xpath_fields.items():
+		if (callable(expr)):
+			compiled_fields[name] = expr
+		else:
+			compiled_fields[name] = ET.XPath(expr,namespaces=cml_namespaces)
+	return compiled_fields
+
+def get_xpath_fields(program_key):
+	'''Fetch the compiled XPath fields for a program from the registry, compiling them on first use.
+	Input:
+	- program_key. String, key of the program in program_xpath_fields.
+	Output:
+	- compiled_fields. Dict mapping field names to compiled XPath expressions, as in compile_xpath_fields().'''
+	if (program_key not in xpath_registry):
+		xpath_registry[program_key] = compile_xpath_fields(program_xpath_fields[program_key])
+	return xpath_registry[program_key]
+
+def select_xpath_fields(doc):
+	'''Choose the compiled XPath fields for a CML document according to the program that generated it,
+	falling back to default_program when the program is missing or unknown.
+	Input:
+	- doc. ET.ElementTree or ET.Element for the parsed CML document.
+	Output:
+	- compiled_fields. Dict mapping field names to compiled XPath expressions, as in compile_xpath_fields().'''
+	program = detect_program(doc)
+	program_key = default_program
+	if (program):
+		for prog_key in program_xpath_fields.keys():
+			if (program.lower().startswith(prog_key)):
+				program_key = prog_key
+				break
+	return get_xpath_fields(program_key)
+
+def convert_field(value,field_type):
+	'''Convert a string value extracted from a CML file to the type specified in the parsing rules
+	(resources/parsing_rules.dat in ontorxn_tools).
+	Input:
+	- value. String, value of the field.
+	- field_type. String, one of Float, Integer, Vector or String. Vectors are returned as lists of floats.
+	Output:
+	- typed_value. Converted value, or the original string if it cannot be converted.'''
+	try:
+		if (field_type == "Float"):
+			return float(value)
+		elif (field_type == "Integer"):
+			return int(value)
+		elif (field_type == "Vector"):
+			return [float(item) for item in value.split()]
+	except ValueError:
+		pass
+	return value
+
+def xpath_parsing(cml_file,field_types=None,xpath_fields=None,jobs=None):
+	'''Direct parsing of CML files via precompiled XPath expressions, returning the same fields as
+	xslt_parsing() without the intermediate text output, so values are not split on separators.
+	Input:
+	- cml_file. String, name of the CML file to be parsed.
+	- field_types. Dict mapping field names to data types (Float, Integer, Vector or String), as in the parsing rules.
+	If None, all values are kept as strings, as in xslt_parsing().
+	- xpath_fields. Dict mapping field names to XPath expressions, as in gaussian_xpath_fields. If None, select them
+	from program_xpath_fields according to the program in the CML file.
+	- jobs. Integer or list of integers, 0-based indices of the cc:job entries to parse, streamed as in xslt_parsing().
+	Output:
+	- job_cml_fields. List of dicts for each cc:job (or for every requested job), containing key:value pairs for all
+	the non-empty fields.'''
+	if (jobs is not None):
+		doc = stream_jobs(cml_file,jobs)
+	else:
+		doc = ET.parse(cml_file)
+	if (xpath_fields):
+		compiled_fields = compile_xpath_fields(xpath_fields)
+	else:
+		compiled_fields = select_xpath_fields(doc)
+	if (not field_types):
+		field_types = {}
+	job_cml_fields = []
+	for job in doc.xpath(job_xpath,namespaces=cml_namespaces):
+		parsed_dict = {}
+		for name,xpath_fn in compiled_fields.items():
+			value = str(xpath_fn(job)).strip()
+			if (not value):
+				continue
+			parsed_dict[name] = convert_field(value,field_types.get(name,"String"))
+		job_cml_fields.append(parsed_dict)
 	return job_cml_fields
@@ -1,16 +1,280 @@
 '''Diego Garay-Ruiz, January 2022
 Management of the DOT-formatted graphs generated in ioChem-BD reports'''
 import re
-import xmltodict
+import io
+import lxml.etree as ET
 import networkx as nx
 from networkx.drawing.nx_pydot import read_dot
 from operator import itemgetter
 from collections import defaultdict
 
+# Series membership as integer bitmasks: bit k is set if the node/edge belongs to the serie with key k
+def key_mask(keys):
+	'''Transform a list of integer keys into a bitmask'''
+	mask = 0
+	for k in keys:
+		mask |= 1 << k
+	return mask
+
+def mask_keys(mask):
+	'''Transform a bitmask into the sorted list of integer keys it contains'''
+	keys = []
+	k = 0
+	while (mask):
+		if (mask & 1):
+			keys.append(k)
+		mask >>= 1
+		k += 1
+	return keys
+
+def element_mask(attr_dict):
+	'''Bitmask for the attribute dict of a node or edge, from the keymask attribute or, if missing, from key'''
+	mask = attr_dict.get("keymask")
+	if (mask is None):
+		mask = key_mask(attr_dict.get("key",[]))
+	return mask
+
+def graph_mask(G):
+	'''Bitmask with all the series present in the nodes of a graph'''
+	mask = 0
+	for nd,ndata in G.nodes(data=True):
+		mask |= element_mask(ndata)
+	return mask
+
+def series_subgraph(G,keys):
+	'''Select the nodes and edges of a graph belonging to at least one of the requested series, via their
+	bitmasks.
+	Input:
+	- G. nx.Graph with key (and keymask) attributes, as generated by dot_reader() or graph_read_split().
+	- keys. List of integer keys for the series to be selected.
+	Output:
+	- Gsel. nx.Graph (a copy) with the selected nodes and edges and the corresponding SerieNames.'''
+	sel_mask = key_mask(keys)
+	Gsel = nx.Graph()
+	Gsel.add_nodes_from((nd,ndata) for nd,ndata in G.nodes(data=True) if element_mask(ndata) & sel_mask)
+	Gsel.add_edges_from((nd1,nd2,edata) for nd1,nd2,edata in G.edges(data=True)
+						if element_mask(edata) & sel_mask and nd1 in Gsel and nd2 in Gsel)
+	Gsel.graph.update(G.graph)
+	series_dict = G.graph.get("SerieNames",{})
+	Gsel.graph["SerieNames"] = {k:series_dict[k] for k in mask_keys(graph_mask(Gsel) & sel_mask) if k in series_dict}
+	return Gsel
+
+# Native reader for the DOT dialect generated by ioChem-BD
+dot_token_regex = re.compile(r'''
+	(?P<skip>\s+|//[^\n]*|/\*.*?\*/|\#[^\n]*)
+	|(?P<str>"(?:[^"\\]|\\.)*")
+	|(?P<edgeop>--|->)
+	|(?P<id>[A-Za-z_\x80-\uffff][\w\x80-\uffff]*|-?(?:\.\d+|\d+(?:\.\d*)?))
+	|(?P<punct>[\[\]{}=;,:])
+	''',re.VERBOSE|re.DOTALL)
+
+def dot_tokens(dot_text):
+	'''Generator for the tokens in a DOT-formatted string, skipping whitespace and comments.
+	Input:
+	- dot_text. String, contents of a DOT file.
+	Output:
+	- Yields (kind,text) tuples, with kind being str (quoted string, quotes kept), id, edgeop or punct.'''
+	for match in dot_token_regex.finditer(dot_text):
+		kind = match.lastgroup
+		if (kind != "skip"):
+			yield kind,match.group()
+
+def dot_statements(dot_text):
+	'''Single-pass parser for the DOT statements in a string, covering the subset of the language generated by
+	ioChem-BD (node and edge statements with attribute lists). Default attribute statements (node, edge, graph),
+	graph attributes and ports are skipped, as done by networkx.drawing.nx_pydot.read_dot().
+	Input:
+	- dot_text. String, contents of a DOT file.
+	Output:
+	- Yields ("header",directed,None) once, then ("node",name,attrs) and ("edge",[name1,name2,...],attrs) tuples,
+	with node names unquoted and attribute values kept as in the file (including quotes).'''
+	ids = []
+	attrs = {}
+	header = False
+	depth = 0
+	expect_id = False
+	skip_next = False
+	tokens = dot_tokens(dot_text)
+	for kind,text in tokens:
+		if (skip_next):
+			skip_next = False
+			continue
+		if (kind == "id" and text.lower() in ("strict","graph","digraph","subgraph") and
+			(depth == 0 or text.lower() == "subgraph")):
+			if (depth == 0 and not header):
+				yield "header",(text.lower() == "digraph"),None
+			header = True
+			continue
+		if (header):
+			if (text == "{"):
+				header = False
+				depth += 1
+			continue
+		if (kind in ("str","id")):
+			name = text.strip('"')
+			if (expect_id):
+				ids.append(name)
+				expect_id = False
+				continue
+			if (ids):
+				yield from dot_flush(ids,attrs)
+			ids,attrs = [name],{}
+		elif (kind == "edgeop"):
+			expect_id = True
+		elif (text == "["):
+			# attribute list: key=value pairs separated by commas or semicolons
+			pending_key = None
+			for akind,atext in tokens:
+				if (atext == "]"):
+					break
+				if (atext in (",",";")):
+					continue
+				if (atext == "="):
+					continue
+				if (pending_key is None):
+					pending_key = atext.strip('"')
+				else:
+					attrs[pending_key] = atext
+					pending_key = None
+		elif (text == "="):
+			# graph attribute (ID = ID): drop it
+			ids,attrs = [],{}
+			skip_next = True
+		elif (text == ":"):
+			# port specification: ignored
+			skip_next = True
+		elif (text in (";","{","}")):
+			yield from dot_flush(ids,attrs)
+			ids,attrs = [],{}
+			depth += {"{":1,"}":-1}.get(text,0)
+	yield from dot_flush(ids,attrs)
+
+def dot_flush(ids,attrs):
+	'''Helper for dot_statements(), yielding the node or edge statement for a list of IDs and attributes'''
+	if (not ids or (len(ids) == 1 and ids[0] in ("node","edge","graph"))):
+		return
+	if (len(ids) == 1):
+		yield "node",ids[0],attrs
+	else:
+		yield "edge",ids,attrs
+
+def dot_parser(graph_filename):
+	'''
+	Read a DOT file generated by ioChem-BD in a single pass, parsing the comma-separated lists of keys and the
+	serie names, and merging all edges between the same pair of nodes.
+	Input:
+	- graph_filename. String, name of the DOT file to be read
+	Output:
+	- node_attrs. Dict mapping node names to their attribute dicts, in file order.
+	- edge_list. List of (node1,node2,attr_dict) tuples for the merged edges, in the order in which networkx
+	would build them from a MultiGraph.
+	- series_dict. Dict mapping keys to serie names.
+	'''
+	with open(graph_filename,"r") as fdot:
+		dot_text = fdot.read()
+	directed = False
+	node_attrs = {}
+	edge_statements = []
+	for stmt_type,stmt_ids,stmt_attrs in dot_statements(dot_text):
+		if (stmt_type == "header"):
+			directed = stmt_ids
+		elif (stmt_type == "node"):
+			node_attrs.setdefault(stmt_ids,{}).update(stmt_attrs)
+		else:
+			edge_statements.append((stmt_ids,stmt_attrs))
+
+	# Nodes: parse keys and serie names from the tooltips
+	series_information = []
+	for attr_dict in node_attrs.values():
+		key_list = (attr_dict['key'][1:-1]).split(",")
+		attr_dict['key'] = [int(keyval) for keyval in key_list]
+		attr_dict['keymask'] = key_mask(attr_dict['key'])
+		tooltip_names = attr_dict["tooltip"][1:-1].strip().split("\\n")
+		serie_names = [re.sub(":.*","",tooltip) for tooltip in tooltip_names]
+		series_information.extend(zip(attr_dict["key"],serie_names))
+		attr_dict.pop('energy',None)
+		attr_dict.pop('tooltip',None)
+	clean_series_info = sorted(list(set(series_information)),key=itemgetter(0))
+	series_dict = {key:sname for key,sname in clean_series_info}
+
+	# Edges: merge all edges between the same pair of nodes, keeping the attributes of the first key and
+	# collecting the keys (repeated keys update the attributes, as in a MultiGraph). Adjacency is tracked to
+	# add the edges in the same order as networkx would
+	adjacency = {}
+	pair_data = {}
+	for stmt_ids,stmt_attrs in edge_statements:
+		for nd1,nd2 in zip(stmt_ids[:-1],stmt_ids[1:]):
+			for nd in (nd1,nd2):
+				if (nd not in node_attrs):
+					node_attrs[nd] = {}
+				adjacency.setdefault(nd,{})
+			pair = (nd1,nd2) if directed else frozenset((nd1,nd2))
+			key = int(stmt_attrs['key'][1:-1])
+			if (pair not in pair_data):
+				pair_data[pair] = {}
+				adjacency[nd1][nd2] = pair
+				if (not directed):
+					adjacency[nd2][nd1] = pair
+			pair_data[pair].setdefault(key,{}).update(stmt_attrs)
+	for pair,key_dict in pair_data.items():
+		first_attrs = next(iter(key_dict.values()))
+		attr_dict = {k:v for k,v in first_attrs.items() if k not in ("key","energy","labeltooltip")}
+		attr_dict['key'] = list(key_dict.keys())
+		pair_data[pair] = attr_dict
+
+	# Sort edges as networkx would, merging opposite edges in directed graphs
+	edge_list = []
+	edge_index = {}
+	seen = set()
+	for nd in node_attrs.keys():
+		for nbr,pair in adjacency.get(nd,{}).items():
+			if (directed or nbr not in seen):
+				und_pair = frozenset((nd,nbr))
+				if (und_pair in edge_index):
+					edge_list[edge_index[und_pair]][2]['key'].extend(pair_data[pair]['key'])
+				else:
+					edge_index[und_pair] = len(edge_list)
+					edge_list.append((nd,nbr,pair_data[pair]))
+		seen.add(nd)
+	for nd1,nd2,attr_dict in edge_list:
+		attr_dict['keymask'] = key_mask(attr_dict['key'])
+	return node_attrs,edge_list,series_dict
+
+def native_dot_reader(graph_filename):
+	'''
+	Read a DOT file generated by ioChem-BD via dot_parser(), building directly the nx.Graph with merged edges,
+	attribute lists for keys and SerieNames that is produced by pydot_dot_reader(), without intermediate pydot
+	or MultiGraph objects.
+	Input:
+	- graph_filename. String, name of the DOT file to be read
+	Output:
+	- Gworking. nx.Graph object with attribute lists for keys.
+	'''
+	node_attrs,edge_list,series_dict = dot_parser(graph_filename)
+	Gworking = nx.Graph()
+	Gworking.graph["SerieNames"] = series_dict
+	Gworking.add_nodes_from(node_attrs.items())
+	Gworking.add_edges_from(edge_list)
+	return Gworking
+
 # Functions for graph processing
-def dot_reader(graph_filename):
+def dot_reader(graph_filename,engine="native"):
+	'''
+	Read a DOT file from ioChem-BD as a nx.Graph object, merging repeated edges and parsing the comma-separated
+	lists of attributes into valid Python lists.
+	Input:
+	- graph_filename. String, name of the DOT file to be read
+	- engine. String, native to use native_dot_reader() or pydot to use pydot_dot_reader()
+	Output:
+	- Gworking. nx.Graph object with attribute lists for keys.
+	'''
+	if (engine == "pydot"):
+		return pydot_dot_reader(graph_filename)
+	return native_dot_reader(graph_filename)
+
+def pydot_dot_reader(graph_filename):
 	'''
-	Read a DOT file as a NetworkX.MultiGraph object and parse the comma-separated
+	Read a DOT file as a NetworkX.MultiGraph object via pydot and parse the comma-separated
 	lists of attributes from ioChem into valid Python lists.
 	Input:
 	- graph_filename. String, name of the DOT file to be read
@@ -57,6 +321,9 @@ def dot_reader(graph_filename):
 			# if the edge was already present, append key
 			ed_dict = Gworking.edges[edge[0],edge[1]]
 			ed_dict['key'].append(edge[3]['key'])
+	# Bitmasks for series membership
+	for elem_data in list(Gworking.nodes.values()) + [ed[2] for ed in Gworking.edges(data=True)]:
+		elem_data['keymask'] = key_mask(elem_data['key'])
 	return Gworking
 
 def dot_processor(G_input,used_keys='all'):
@@ -79,9 +346,8 @@ def dot_processor(G_input,used_keys='all'):
 
 	# Key selection
 	if (used_keys == 'all') or (type(used_keys) != list):
-		# get the list of all possible key values looping through nodes
-		all_key_vals = [item for entry in G_input.nodes(data='key') for item in entry[1]]
-		used_keys = list(set(all_key_vals))
+		# get the list of all possible key values from the bitmasks of the nodes
+		used_keys = mask_keys(graph_mask(G_input))
 	
 	# Instantiate a new Graph object
 	G_uniq = nx.Graph()
@@ -146,6 +412,8 @@ def node_renamer(in_graph):
 def node_collapser(in_graph):
 	'''For every node and edge in the graph, check the 'name' field, in order to contract
 	nodes that share the same name.
+	The graph is copied once and all same-name groups are then contracted in-place, so every contraction
+	only touches the edges of the merged node, keeping the edge and 'contraction' attributes of nx.contracted_nodes.
 	Input:
 	- in_graph. nx.Graph object to be modified.
 	Output:
@@ -157,9 +425,8 @@ def node_collapser(in_graph):
 	out_graph = in_graph.copy()
 	collapsed_node_dict = {k:v for k,v in match_dict.items() if len(v) > 1}
 	for name,nd_ids in collapsed_node_dict.items():
-		pairlist = [(nd_ids[0],nd) for nd in nd_ids[1:]]
-		for pair in pairlist:
-			out_graph = nx.contracted_nodes(out_graph,pair[0],pair[1])
+		for nd in nd_ids[1:]:
+			nx.contracted_nodes(out_graph,nd_ids[0],nd,copy=False)
 	return out_graph
 
 def read_iochem_graph(graph_filename,used_keys='all',rename_nodes=False):
@@ -185,6 +452,7 @@ def read_iochem_graph(graph_filename,used_keys='all',rename_nodes=False):
 def graph_read_split(gfile,rename_nodes=True,collapse_nodes=False):
 	'''For a DOT-formatted file from ioChem-BD, check for the presence of unconnected subgraphs,
 	and provide a list where each of these entities has been processed to a nx.Graph.
+	Graphs are built in a single pass via graph_build_split().
 	Input:
 	- gfile. String, name of the DOT file to be read, as downloaded from ioChem-BD
 	- rename_nodes. Boolean, if True, update node names in nodes and edges by the 'name' property,
@@ -194,57 +462,127 @@ def graph_read_split(gfile,rename_nodes=True,collapse_nodes=False):
 	Output:
 	- G_list. List of processed nx.Graph entities for all subgraphs in the input file.
 	'''
-	# Read the input file, without renaming, and split the resulting graph by connected components
-	Gx = read_iochem_graph(gfile,'all')
-	G_list_raw = [Gx.subgraph(gs).copy() for gs in nx.connected_components(Gx)]
-	# Apply collapsing and renaming over the corresponding subgraphs, if requested
-	if (collapse_nodes):
-		G_list_raw[:] = [node_collapser(gs) for gs in G_list_raw]
-	G_list = [node_renamer(gs) for gs in G_list_raw]
-	# Include the corresponding serie names per subgraph
-	for Gii in G_list:
-		current_keys = [k for nd in Gii.nodes(data="key") for k in nd[1]]
-		unique_keys = list(set(current_keys))
-		Gii.graph["SerieNames"] = {k:Gx.graph["SerieNames"][k] for k in unique_keys}
+	node_attrs,edge_list,series_dict = dot_parser(gfile)
+	G_list = graph_build_split(node_attrs,edge_list,series_dict,rename_nodes,collapse_nodes)
+	return G_list
+
+def element_namer(node_attrs,edge_list):
+	'''In-place version of the processing in dot_processor(): add nameid, name and formula to the attribute
+	dicts of nodes and edges generated by dot_parser().
+	Input:
+	- node_attrs. Dict mapping node names to attribute dicts.
+	- edge_list. List of (node1,node2,attr_dict) tuples.
+	Output:
+	- None, dicts are modified in-place.'''
+	for nd,attr_dict in node_attrs.items():
+		attr_dict['nameid'] = str(nd)
+		attr_dict['name'] = attr_dict['label'].split("\\n")[0][1:]
+		attr_dict['formula'] = None
+	for nd1,nd2,attr_dict in edge_list:
+		# Handle missing and closing edges, which are labeled in the corresponding entry
+		label_raw = attr_dict['label']
+		if ('missing' in label_raw):
+			attr_dict["name"] = label_raw[2:-1]
+		elif ('Closing' in label_raw):
+			attr_dict["name"] = "closing" + str(attr_dict["key"][0])
+		else:
+			attr_dict["name"] = label_raw.split("\\n")[0][1:]
+		attr_dict['formula'] = None
+	return None
+
+def graph_build_split(node_attrs,edge_list,series_dict,rename_nodes=True,collapse_nodes=False):
+	'''Build the processed nx.Graph for every connected component of a graph parsed by dot_parser() in a single
+	pass: components are found on the parsed data, and each node or edge is only inserted once, in its final
+	(renamed) graph, avoiding the intermediate graphs and copies of dot_processor(), subgraph() and node_renamer().
+	Input:
+	- node_attrs, edge_list, series_dict. Output of dot_parser(). Attribute dicts are modified in-place.
+	- rename_nodes. Boolean, if True, use the 'name' property as node ID, if names are unique within the component.
+	- collapse_nodes. Boolean. If True, contract nodes with the same name via node_collapser().
+	Output:
+	- G_list. List of processed nx.Graph entities for all connected components.
+	'''
+	element_namer(node_attrs,edge_list)
+	# Connected components via union-find
+	parent = {nd:nd for nd in node_attrs}
+	def find(nd):
+		while (parent[nd] != nd):
+			parent[nd] = parent[parent[nd]]
+			nd = parent[nd]
+		return nd
+	for nd1,nd2,attr_dict in edge_list:
+		root1,root2 = find(nd1),find(nd2)
+		if (root1 != root2):
+			parent[root2] = root1
+	# Group nodes and edges by component, in order of first appearance
+	comp_nodes = {}
+	for nd in node_attrs:
+		comp_nodes.setdefault(find(nd),[]).append(nd)
+	comp_edges = {root:[] for root in comp_nodes}
+	for edge in edge_list:
+		comp_edges[find(edge[0])].append(edge)
+
+	G_list = []
+	for root,nodes in comp_nodes.items():
+		edges = comp_edges[root]
+		mapping = None
+		if (rename_nodes and not collapse_nodes):
+			mapping = {nd:node_attrs[nd]['name'] for nd in nodes}
+			if (len(set(mapping.values())) != len(nodes)):
+				print("The 'name' field did not contain valid, unique identifiers")
+				print("Original IDs are kept")
+				mapping = None
+		Gc = nx.Graph()
+		if (mapping):
+			Gc.add_nodes_from((mapping[nd],node_attrs[nd]) for nd in nodes)
+			Gc.add_edges_from((mapping[nd1],mapping[nd2],attr_dict) for nd1,nd2,attr_dict in edges)
+		else:
+			Gc.add_nodes_from((nd,node_attrs[nd]) for nd in nodes)
+			Gc.add_edges_from(edges)
+		if (collapse_nodes):
+			Gc = node_collapser(Gc)
+			if (rename_nodes):
+				Gc = node_renamer(Gc)
+		# Serie names of the keys in the component
+		Gc.graph["SerieNames"] = {k:series_dict[k] for k in mask_keys(graph_mask(Gc))}
+		G_list.append(Gc)
 	return G_list
 
+def formula_index(config_xml):
+	'''Build a mapping between step names and formulas from the configuration XML of a report, streaming
+	through the serie/step elements. If a name appears in several series, the first formula is kept.
+	Input:
+	- config_xml. String, configuration block of the report properties.
+	Output:
+	- formula_dict. Dict mapping step names (labels) to formulas.'''
+	formula_dict = {}
+	for event,elem in ET.iterparse(io.BytesIO(config_xml.encode()),events=("end",)):
+		if (ET.QName(elem).localname != "step"):
+			continue
+		if (ET.QName(elem.getparent()).localname == "serie"):
+			name = elem.get("label")
+			if (name not in formula_dict):
+				formula_dict[name] = (elem.text or "").strip()
+		elem.clear()
+	return formula_dict
+
 def formula_mapper(G_list,property_list):
 	'''Helper function to map the formulas defined in the report to the corresponding graph (which does not contain these formulas)
+	The configuration is parsed once via formula_index(), and every graph is then traversed once, assigning
+	formulas to the nodes and TS edges whose names are in the index.
 	Input:
 	- G_list. List of nx.Graph objects as generated by read_iochem_graph()
 	- property_list. List of properties extracted for a report via the JSON dump of ReportHandler.get_report_properties()
 	Output:
 	- None. Graphs in the list are modified in-place.
 	'''
-	# Now use report/profile information to build the knowledge graph
-	cblock = property_list["configuration"]
-	# Transform to an object, access series
-	block = xmltodict.parse(cblock)
-	series_info = block["configuration"]["parameters"]["series"]["serie"]
-	# Handle situations where a single series is present by transforming to a list
-	if (not isinstance(series_info,list)):
-		series_info = [series_info]
-	# Go along all existing graphs and match formula information
-	for ig,G in enumerate(G_list):
-		#And now we can iterate along all defined series
-		known_elements = []
-		tsdict = {ed[2]:ed[0:2] for ed in G.edges(data="name")}
-		for serie in series_info:
-			sname = serie['@name']
-			elements = serie['step']
-			# we want to assign this information to the graph
-			for elem in elements:
-				name,formula = [elem[key] for key in ["@label","#text"]]
-				print(name,formula)
-				if (name in known_elements):
-					continue
-				else:
-					known_elements.append(name)
-				# Graph update
-				if ("TS" in name):
-				# fetch the corresponding edge
-					edge = tsdict[name]
-					G.edges[edge]["formula"] = formula
-				else:
-					G.nodes[name]["formula"] = formula
+	formula_dict = formula_index(property_list["configuration"])
+	for G in G_list:
+		for nd,ndata in G.nodes(data=True):
+			if ("TS" not in str(nd) and nd in formula_dict):
+				ndata["formula"] = formula_dict[nd]
+		# TSs are matched to edges by name: if names are repeated, the last edge is used
+		tsdict = {ed[2]:ed[0:2] for ed in G.edges(data="name") if ed[2] and "TS" in ed[2]}
+		for name,edge in tsdict.items():
+			if (name in formula_dict):
+				G.edges[edge]["formula"] = formula_dict[name]
 	return None
@@ -7,13 +7,52 @@ from collections import OrderedDict
 import configparser
 import re
 import json
+import time
+import os
+import os.path
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .ReportRecorder import ResponseRecorder
+
+# Fields of the file listing of a calculation that change along with the contents of the file. If the listing
+# carries any of them, an unchanged value is enough to skip the download in ReportHandler.cml_download()
+listing_content_fields = ["size","checksum","sha256","md5","lastModified","modificationDate"]
+
+def file_checksum(filename,chunk_size=1024**2):
+	'''SHA-256 hex digest of the contents of a local file, read in chunks'''
+	digest = hashlib.sha256()
+	with open(filename,"rb") as fhash:
+		for chunk in iter(lambda: fhash.read(chunk_size),b""):
+			digest.update(chunk)
+	return digest.hexdigest()
 
 class ReportHandler:
 	'''Management of ioChem-BD's Create module REST API'''
-	def __init__(self,report_id=None,config_file=None,verify=True,**kwargs):
+	def __init__(self,report_id=None,config_file=None,verify=True,pool_size=10,timeout=60,
+				 retries=3,backoff=0.5,record_dir=None,replay_dir=None,cache_ttl=300,response_cache=None,**kwargs):
 		self.rid = report_id
 		self.verify = verify
+		self.timeout = timeout
+		# In-process cache for report-level GET requests, mapping URLs to (timestamp,response) tuples. A dict can be
+		# passed to share it among several handlers
+		self.cache_ttl = cache_ttl
+		if (response_cache is None):
+			response_cache = {}
+		self.response_cache = response_cache
+		self.cache_lock = threading.Lock()
+		# Optional recording of all responses to a directory, or replay from a previous recording (no network)
+		self.recorder = None
+		self.replay_mode = bool(replay_dir)
+		if (replay_dir):
+			self.recorder = ResponseRecorder(replay_dir)
+		elif (record_dir):
+			self.recorder = ResponseRecorder(record_dir)
+		# Pooled session, keeping connections alive between requests and retrying on transient errors
+		self.session_builder(pool_size,retries,backoff)
 		# Instantiate empty entities for the dict of properties and the list of calculations
 		self.property_dict = {}
 		self.calc_list = []
@@ -40,6 +79,87 @@ class ReportHandler:
 		self.headers = headers
 		return None
 
+	def session_builder(self,pool_size=10,retries=3,backoff=0.5):
+		'''Instantiate the requests.Session used for all requests, with a connection pool of pool_size connections
+		per host and retries with exponential backoff for connection errors and 5xx responses. POST requests are
+		not retried, as they may not be idempotent.'''
+		retry = Retry(total=retries,backoff_factor=backoff,status_forcelist=[500,502,503,504],
+					  raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size,max_retries=retry)
+		self.session = requests.Session()
+		self.session.mount("http://",adapter)
+		self.session.mount("https://",adapter)
+		self.adapter = adapter
+		self.pool_size = pool_size
+		self.counters = {"requests":0,"elapsed":0.0}
+		self.counter_lock = threading.Lock()
+		return None
+
+	def send_request(self,method,url,header_type,extra_headers=None,**kwargs):
+		'''Send a request through the pooled session, updating the request counters.
+		- method. String, HTTP method (GET or POST).
+		- url. String, full URL for the request.
+		- header_type. String, key for self.headers (GET, POST or GETB).
+		- extra_headers. Dict, additional headers for this request only (e.g. for conditional requests).
+		Additional keyword arguments are passed to requests.Session.request()
+		In replay mode, the response is taken from the recording instead, and in record mode it is stored.'''
+		headers = self.headers[header_type]
+		if (extra_headers):
+			headers = dict(headers,**extra_headers)
+		t0 = time.perf_counter()
+		if (self.replay_mode):
+			response = self.recorder.replay(method,url,kwargs.get("data"))
+		else:
+			response = self.session.request(method,url,headers=headers,verify=self.verify,
+											timeout=self.timeout,**kwargs)
+			if (self.recorder and response.status_code != 304):
+				self.recorder.record(method,url,response,kwargs.get("data"))
+		with self.counter_lock:
+			self.counters["requests"] += 1
+			self.counters["elapsed"] += time.perf_counter() - t0
+		return response
+
+	def request_stats(self):
+		'''Summary of the requests sent by the handler: number of requests, total and mean latency (in seconds)
+		and number of connections opened by the pool'''
+		pools = self.adapter.poolmanager.pools
+		connections = sum([pools[key].num_connections for key in pools.keys()])
+		Nreq = self.counters["requests"]
+		stats = {"requests":Nreq,"connections":connections,"elapsed":self.counters["elapsed"],
+				 "mean_latency":self.counters["elapsed"]/Nreq if Nreq else 0.0}
+		return stats
+
+	def cached_get(self,url,header_type="GET"):
+		'''GET request through the in-process response cache: successful responses are reused for
+		self.cache_ttl seconds (use 0 to disable the cache).
+		- url. String, full URL for the request.
+		- header_type. String, key for self.headers.'''
+		with self.cache_lock:
+			cached = self.response_cache.get(url)
+		if (cached and time.monotonic() - cached[0] < self.cache_ttl):
+			return cached[1]
+		response = self.send_request("GET",url,header_type)
+		if (response.status_code == 200 and self.cache_ttl > 0):
+			with self.cache_lock:
+				self.response_cache[url] = (time.monotonic(),response)
+		return response
+
+	def invalidate_cache(self,url=None):
+		'''Remove a given URL from the response cache, or clear the whole cache if url is None'''
+		with self.cache_lock:
+			if (url is None):
+				self.response_cache.clear()
+			else:
+				self.response_cache.pop(url,None)
+		return None
+
+	def close(self):
+		'''Close the pooled session and all its connections, and save the index of the recording in record mode'''
+		self.session.close()
+		if (self.recorder and not self.replay_mode):
+			self.recorder.close()
+		return None
+
 	def iochem_header_generator(self,passwd):
 		'''Instantiate the required GET, POST and GETB headers from auth data, and return in a dictionary'''
 		headers_get = {'Accept':'application/json','Authorization': 'Basic ' + passwd}
@@ -53,7 +173,7 @@ class ReportHandler:
 		'''Build a GET request for a base URL, optionally adding additional arguments'''
 		if (url_base):
 			url = url_base + url_addition
-			request = requests.get(url,headers=self.headers["GET"],verify=self.verify)
+			request = self.send_request("GET",url,"GET")
 			return request
 		else:
 			return None
@@ -63,22 +183,22 @@ class ReportHandler:
 		optionally adding additional arguments'''
 		if (url_base):
 			url = url_base + url_addition
-			request = requests.post(url,headers=self.headers["POST"],data=pass_data,verify=self.verify)
+			request = self.send_request("POST",url,"POST",data=pass_data)
 			return request
 		else:
 			return None
 
 	# Report-specific functions, using ReportHandler attributes to simplify the syntax of requests
 	def get_report_properties(self):
-		'''GET request for the properties associated with a report'''
+		'''GET request for the properties associated with a report (cached, see self.cached_get())'''
 		url = self.rurl + str(self.rid)
-		request = requests.get(url, headers=self.headers["GET"], verify=self.verify)
+		request = self.cached_get(url)
 		return request
 
 	def get_report_calcs(self):
-		'''GET request for the list of calculations (including calcIds)'''
+		'''GET request for the list of calculations (including calcIds) (cached, see self.cached_get())'''
 		url = self.rurl + str(self.rid) + "/calculation"
-		request = requests.get(url, headers=self.headers["GET"], verify=self.verify)
+		request = self.cached_get(url)
 		return request
 
 	def get_calc_files(self, calcId):
@@ -86,24 +206,25 @@ class ReportHandler:
 		calcId: integer identifier for a calculation
 		'''
 		url = self.calcurl + str(calcId) + "/file"
-		request = requests.get(url, headers=self.headers["GET"],verify=self.verify)
+		request = self.send_request("GET",url,"GET")
 		return request
 
-	def get_file(self, calcId, fileId):
+	def get_file(self, calcId, fileId, stream=False, extra_headers=None):
 		'''GET request to fetch a specific file from a calculation.
 		calcId: integer identifier for a calculation
 		fileId: integer identifier for a specific file, obtained from self.get_calc_files()
+		stream: boolean, if True do not download the body until it is accessed (e.g. via iter_content())
+		extra_headers: dict of additional headers, e.g. If-None-Match for conditional requests
 		'''
 		url = self.calcurl + str(calcId) + "/file/" + str(fileId)
-		request = requests.get(url, headers=self.headers["GETB"],verify=self.verify)
+		request = self.send_request("GET",url,"GETB",extra_headers=extra_headers,stream=stream)
 		return request
 
 	def create_report(self,auto_rid=True):
 		'''POST request to instantiate a new report in ioChem-BD, with automatic assignment of a reportId'''
 		url = self.rurl
 		print(json.dumps(self.property_dict))
-		response = requests.post(url,headers=self.headers["POST"],
-								 data=json.dumps(self.property_dict),verify=self.verify)
+		response = self.send_request("POST",url,"POST",data=json.dumps(self.property_dict))
 		if (auto_rid):
 			resp_json = response.json()
 			print(resp_json)
@@ -119,7 +240,9 @@ class ReportHandler:
 		- title. String, name of the calculation.
 		- reportId. Integer, id of the report to which the calculation is assigned.'''
 		url = self.rurl + str(self.rid) + "/calculation"
-		response = requests.post(url, headers=self.headers["POST"], verify=self.verify, data=calcData)
+		response = self.send_request("POST",url,"POST",data=calcData)
+		# the list of calculations has changed
+		self.invalidate_cache(url)
 		return response
 
 	# Simultaneous request & JSON-dump for report properties and calculation information
@@ -129,25 +252,105 @@ class ReportHandler:
 		r2 = self.get_report_calcs()
 		return r1.json(),r2.json()
 	
-	def batch_cml_dump(self):
+	def cml_download(self,calc,chunk_size=1024**2,known_entry=None):
+		'''Fetch the CML file for a single calculation, streaming its contents to disk in chunks.
+		- calc. Dict with calculation information, as in the JSON dump of self.get_report_calcs()
+		- chunk_size. Integer, size in bytes of the chunks written to disk.
+		- known_entry. Dict, manifest entry for the calculation from a previous self.sync_cml_files() run. If passed
+		and the local file is unchanged, the file is only downloaded if it changed in the server.
+		Returns the name of the written file, calc_CID.cml, and its manifest entry. Raises requests.HTTPError if the server
+		answers with any status other than 200 (or 304 for conditional requests).'''
+		cid = calc["calcId"]
+		calcfiles = self.get_calc_files(cid).json()
+		# Fetch the identifier for the CML file in the calculation
+		cml_info = [cfile for cfile in calcfiles if ".cml" in cfile["name"]][0]
+		ofile_id = cml_info["id"]
+		fn = "calc_%d.cml" % cid
+		extra_headers = {}
+		if (known_entry and known_entry["remote"].get("id") == ofile_id and os.path.isfile(fn)
+			and file_checksum(fn) == known_entry["sha256"]):
+			# If the file listing carries content metadata (size, checksum, modification date), compare it directly
+			content_fields = [field for field in listing_content_fields if field in cml_info]
+			if (content_fields and all(cml_info[field] == known_entry["remote"].get(field) for field in content_fields)):
+				return fn,dict(known_entry,status="unchanged")
+			if (known_entry.get("etag")):
+				extra_headers["If-None-Match"] = known_entry["etag"]
+			if (known_entry.get("last_modified")):
+				extra_headers["If-Modified-Since"] = known_entry["last_modified"]
+		# Get the contents and write to file, hashing them on the fly
+		digest = hashlib.sha256()
+		size = 0
+		with self.get_file(cid,ofile_id,stream=True,extra_headers=extra_headers) as response:
+			if (response.status_code == 304):
+				return fn,dict(known_entry,remote=cml_info,status="unchanged")
+			# Error bodies (after retries) must never be written as CML files
+			if (response.status_code != 200):
+				raise requests.HTTPError("Could not download %s for calc. %d: HTTP %d" % (cml_info["name"],cid,response.status_code),
+										 response=response)
+			# Write to a temporary file, only replacing calc_CID.cml when the download is complete
+			tmp_fn = fn + ".part"
+			try:
+				with open(tmp_fn,"wb") as fcml:
+					for chunk in response.iter_content(chunk_size):
+						fcml.write(chunk)
+						digest.update(chunk)
+						size += len(chunk)
+				os.replace(tmp_fn,fn)
+			finally:
+				if (os.path.isfile(tmp_fn)):
+					os.remove(tmp_fn)
+			entry = {"calcId":cid,"fileId":ofile_id,"filename":fn,"size":size,"sha256":digest.hexdigest(),
+					 "etag":response.headers.get("ETag"),"last_modified":response.headers.get("Last-Modified"),
+					 "remote":cml_info,"status":"downloaded"}
+		return fn,entry
+
+	def batch_cml_dump(self,max_workers=4):
 		'''Fetch the CML files for all the calculations associated with a report,
-		returning a list of strings with all filenames
+		returning a list of strings with all filenames, in the order of the report.
+		- max_workers. Integer, maximum number of concurrent downloads. Use 1 to download serially. Values
+		above the pool_size of the handler do not increase the number of open connections.
+		A failed download raises requests.HTTPError, as in self.cml_download()
 		'''
 		properties,calculations = self.report_dump()
 		print("Fetching %d files" % len(calculations))
+		if (max_workers == 1):
+			downloads = [self.cml_download(calc) for calc in calculations]
+		else:
+			with ThreadPoolExecutor(max_workers=max_workers) as executor:
+				downloads = list(executor.map(self.cml_download,calculations))
+		file_list = [dwn[0] for dwn in downloads]
+		return file_list
+
+	def sync_cml_files(self,manifest_file=None,max_workers=4):
+		'''Incremental version of self.batch_cml_dump(): keep a local JSON manifest with the fileId, size, checksum
+		and ETag/Last-Modified of every downloaded CML file, and on later runs only download the files that are new or
+		have changed, using conditional requests when the server supports them.
+		- manifest_file. String, name of the JSON manifest. If None, use cml_manifest_RID.json
+		- max_workers. Integer, maximum number of concurrent downloads.
+		Returns the list of filenames, in the order of the report, as self.batch_cml_dump()
+		'''
+		if (not manifest_file):
+			manifest_file = "cml_manifest_%s.json" % self.rid
+		manifest = {}
+		if (os.path.isfile(manifest_file)):
+			with open(manifest_file,"r") as fman:
+				manifest = json.load(fman)
+		properties,calculations = self.report_dump()
+		print("Syncing %d files" % len(calculations))
+		known_entries = [manifest.get(str(calc["calcId"])) for calc in calculations]
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			downloads = list(executor.map(self.cml_download,calculations,[1024**2]*len(calculations),known_entries))
+		# Rebuild the manifest with the calculations currently in the report
+		manifest = {}
 		file_list = []
-		for calc in calculations:
-			cid = calc["calcId"]
-			name = calc["title"]
-			calcfiles = self.get_calc_files(cid).json()
-			# Fetch the identifier for the CML file in the calculation
-			ofile_id = [cfile["id"] for cfile in calcfiles if ".cml" in cfile["name"]][0]
-			# Get the contents and write to file
-			cml = self.get_file(cid,ofile_id).text
-			fn = "calc_%d.cml" % cid
-			with open(fn,"w") as fcml:
-				fcml.write(cml)
+		Nfetched = 0
+		for fn,entry in downloads:
+			Nfetched += (entry.pop("status") == "downloaded")
+			manifest[str(entry["calcId"])] = entry
 			file_list.append(fn)
+		print("%d files downloaded, %d unchanged" % (Nfetched,len(file_list) - Nfetched))
+		with open(manifest_file,"w") as fman:
+			json.dump(manifest,fman,indent=1)
 		return file_list
 
 	# Basic management of query requests through the REST API
@@ -176,13 +379,44 @@ class ReportHandler:
 			query_data = [entry['result'] for entry in query_data['results']]
 		return query_data
 
-	def batch_query_execution(self,query_json,get_result=True):
-		'''Apply a query to all calculations in the report
+	def iter_query_execution(self,query_json=None,get_result=True,max_workers=8,keep_order=False):
+		'''Apply a query to all calculations in the report concurrently, yielding (title,result) pairs as soon as they
+		are available.
 		- query_json. String, JSON dict-like query to be passed. If empty, use the current_query attribute
 		- get_results. Boolean, if True fetch the result field in the query only
+		- max_workers. Integer, maximum number of queries running at the same time
+		- keep_order. Boolean, if True yield results in the order of the report, else in order of completion
 		'''
 		calc_list = self.get_report_calcs().json()
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			futures = [executor.submit(self.single_query_execution,calc["calcId"],query_json,get_result)
+					   for calc in calc_list]
+			future_titles = {fut:calc["title"] for fut,calc in zip(futures,calc_list)}
+			if (keep_order):
+				completed = futures
+			else:
+				completed = as_completed(futures)
+			try:
+				for fut in completed:
+					yield future_titles[fut],fut.result()
+			finally:
+				# if the consumer stops early, do not launch the pending queries
+				for fut in futures:
+					fut.cancel()
+
+	def batch_query_execution(self,query_json,get_result=True,max_workers=1):
+		'''Apply a query to all calculations in the report
+		- query_json. String, JSON dict-like query to be passed. If empty, use the current_query attribute
+		- get_results. Boolean, if True fetch the result field in the query only
+		- max_workers. Integer, maximum number of concurrent queries (see self.iter_query_execution()). Use 1 to
+		run the queries serially.
+		'''
 		batch_output = OrderedDict()
+		if (max_workers > 1):
+			for title,query_data in self.iter_query_execution(query_json,get_result,max_workers,keep_order=True):
+				batch_output[title] = query_data
+			return batch_output
+		calc_list = self.get_report_calcs().json()
 		for calc in calc_list:
 			print("Processing calc. %d (%s)" % (calc["calcId"],calc["title"]))
 			query_data = self.single_query_execution(calc["calcId"],query_json,get_result=get_result)
@@ -0,0 +1,183 @@
+'''Diego Garay-Ruiz, 2022
+Record/replay layer for the REST API of ioChem-BD. Responses received by a ReportHandler can be stored
+in a local directory and served back later, either directly by the handler (replay mode) or through a small
+local HTTP server standing in for ioChem-BD, with configurable latency. This allows to test and benchmark the
+whole knowledge graph generation workflow without access to a live ioChem-BD instance.
+Usage of the stand-in server from the command line:
+python -m py_iochem.ReportRecorder RECORD_DIR --port 8000 --latency 0.05'''
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+import requests
+
+# Response headers kept in the recordings
+recorded_headers = ["Content-Type","ETag","Last-Modified"]
+
+def request_key(method,url,data=None):
+	'''Build the key identifying a request in a recording, from the method, the path and query of the URL
+	and, for requests with a body (queries), a hash of the body.
+	Input:
+	- method. String, HTTP method.
+	- url. String, full URL or path of the request.
+	- data. String or bytes, body of the request, if any.
+	Output:
+	- key. String identifying the request.'''
+	url_parts = urlsplit(url)
+	key = method.upper() + " " + url_parts.path
+	if (url_parts.query):
+		key += "?" + url_parts.query
+	if (data):
+		if (isinstance(data,str)):
+			data = data.encode()
+		key += " " + hashlib.sha256(data).hexdigest()
+	return key
+
+class ResponseRecorder:
+	'''Storage of REST API responses in a directory, with an index.json file mapping request keys to the status,
+	headers and body file of every response. The index is kept in memory and written by save(), which must be called
+	(directly or through close()) once recording is done'''
+	def __init__(self,record_dir):
+		self.record_dir = record_dir
+		self.index_file = os.path.join(record_dir,"index.json")
+		self.lock = threading.Lock()
+		os.makedirs(os.path.join(record_dir,"bodies"),exist_ok=True)
+		self.index = {}
+		self.modified = False
+		if (os.path.isfile(self.index_file)):
+			with open(self.index_file,"r") as findex:
+				self.index = json.load(findex)
+
+	def record(self,method,url,response,data=None):
+		'''Store a requests.Response, reading its full body.
+		- method, url, data. As in request_key()
+		- response. requests.Response object to be stored.'''
+		body = response.content
+		body_name = hashlib.sha256(body).hexdigest() + ".bin"
+		headers = {hd:response.headers[hd] for hd in recorded_headers if hd in response.headers}
+		entry = {"status":response.status_code,"headers":headers,"body":"bodies/" + body_name}
+		with self.lock:
+			with open(os.path.join(self.record_dir,entry["body"]),"wb") as fbody:
+				fbody.write(body)
+			self.index[request_key(method,url,data)] = entry
+			self.modified = True
+		return None
+
+	def save(self):
+		'''Write the in-memory index to index.json, if new responses were recorded since the last call.
+		The file is replaced atomically, so an interrupted save never leaves a truncated index'''
+		with self.lock:
+			if (not self.modified):
+				return None
+			tmp_file = self.index_file + ".tmp"
+			with open(tmp_file,"w") as findex:
+				json.dump(self.index,findex,indent=1)
+			os.replace(tmp_file,self.index_file)
+			self.modified = False
+		return None
+
+	def close(self):
+		'''Save the index of the recording'''
+		self.save()
+		return None
+
+	def lookup(self,key):
+		'''Fetch the recorded status, headers and body for a request key, or None if it was not recorded'''
+		entry = self.index.get(key)
+		if (not entry):
+			return None
+		with open(os.path.join(self.record_dir,entry["body"]),"rb") as fbody:
+			body = fbody.read()
+		return entry["status"],entry["headers"],body
+
+	def replay(self,method,url,data=None):
+		'''Build a requests.Response object from the recording, as if the request had been sent.
+		Unknown requests get an empty 404 response.
+		- method, url, data. As in request_key()'''
+		response = requests.Response()
+		response.url = url
+		recorded = self.lookup(request_key(method,url,data))
+		if (recorded):
+			status,headers,body = recorded
+		else:
+			status,headers,body = 404,{},b""
+		response.status_code = status
+		response.headers.update(headers)
+		response._content = body
+		response._content_consumed = True
+		return response
+
+def standin_handler_factory(recorder,latency=0.0):
+	'''Generate a BaseHTTPRequestHandler class serving the responses in a ResponseRecorder, sleeping latency
+	seconds before each response and honoring If-None-Match against the recorded ETags'''
+	class StandInHandler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def log_message(self,format,*args):
+			return None
+
+		def serve_recorded(self,data=None):
+			time.sleep(latency)
+			recorded = recorder.lookup(request_key(self.command,self.path,data))
+			if (not recorded):
+				status,headers,body = 404,{},b""
+			else:
+				status,headers,body = recorded
+				etag = headers.get("ETag")
+				if (etag and self.headers.get("If-None-Match") == etag):
+					status,body = 304,b""
+			self.send_response(status)
+			for hd,value in headers.items():
+				self.send_header(hd,value)
+			self.send_header("Content-Length",str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+			return None
+
+		def do_GET(self):
+			self.serve_recorded()
+
+		def do_POST(self):
+			length = int(self.headers.get("Content-Length",0))
+			self.serve_recorded(self.rfile.read(length))
+
+	return StandInHandler
+
+def serve_recording(record_dir,host="127.0.0.1",port=8000,latency=0.0):
+	'''Start a local HTTP server standing in for ioChem-BD, serving the responses recorded in a directory.
+	ReportHandler objects should point to it keeping the path of the original URLs, e.g. a report recorded from
+	https://SERVER/create/rest/report/ is served at http://HOST:PORT/create/rest/report/
+	Input:
+	- record_dir. String, directory with the recording, as generated by ResponseRecorder.
+	- host, port. Address for the server.
+	- latency. Float, delay in seconds added to every response.
+	Output:
+	- server. ThreadingHTTPServer object, running in a daemon thread. Stop it with server.shutdown()'''
+	recorder = ResponseRecorder(record_dir)
+	server = ThreadingHTTPServer((host,port),standin_handler_factory(recorder,latency))
+	server_thread = threading.Thread(target=server.serve_forever,daemon=True)
+	server_thread.start()
+	return server
+
+def main():
+	argparser = argparse.ArgumentParser(description="Local stand-in server for recorded ioChem-BD reports")
+	argparser.add_argument("record_dir",help="Directory with the recorded responses",type=str)
+	argparser.add_argument("--host",help="Host to bind",type=str,default="127.0.0.1")
+	argparser.add_argument("--port","-p",help="Port to bind",type=int,default=8000)
+	argparser.add_argument("--latency","-t",help="Delay (s) added to every response",type=float,default=0.0)
+	args = argparser.parse_args()
+	server = serve_recording(args.record_dir,args.host,args.port,args.latency)
+	print("Serving %s on %s:%d" % (args.record_dir,args.host,args.port))
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.shutdown()
+
+if (__name__ == "__main__"):
+	main()
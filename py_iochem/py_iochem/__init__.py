@@ -1,3 +1,4 @@
 from .ReportAPIManager import *
+from .CMLCache import CMLCache
 
 